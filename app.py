@@ -1,10 +1,31 @@
+import itertools
+import math
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, after_this_request, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from flask_migrate import Migrate
-from models import Pedal, Manufacturer, setup_db
+from sqlalchemy.exc import SQLAlchemyError
+from models import (db, Pedal, Manufacturer, setup_db, insert_returning,
+                    patch_returning, delete_returning, row_etag,
+                    VersionConflict)
 from auth import AuthError, requires_auth
+from pagination import (MAX_PAGE_SIZE, cursor_args, keyset_page,
+                        order_by_key, page_bounds, page_limits, paginate,
+                        paginate_keyset, uses_cursor)
+from bulk import (MAX_BULK_BATCH_SIZE, batch_size, delete_rows, ingest,
+                  iter_records, patch_rows, validate_changes)
+from budgets import enforce_budgets, query_budget
+from export import export_response
+from metrics import instrument, metrics_response
+from replicas import replicas
+from search import search
+from serializer import encoders, json_response
+from snapshot import catalog
+from tracing import trace_requests
+from cache import cached
+from notify import start_change_listener
+from versions import manufacturer_pedals_key
 
 # Configure app
 
@@ -12,118 +33,373 @@ from auth import AuthError, requires_auth
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.update(test_config)
     setup_db(app)
     CORS(app)
+    instrument(app)
+    enforce_budgets(app)
+    trace_requests(app)
+
+    @app.before_first_request
+    def listen_for_changes():
+        start_change_listener(db.get_engine(app))
 
     @app.after_request
     def after_request(response):
         response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type, Authorization')
+                             'Content-Type, Authorization, '
+                             'If-None-Match, If-Modified-Since, If-Match')
+        response.headers.add('Access-Control-Expose-Headers',
+                             'ETag, Last-Modified')
         response.headers.add('Access-Control-Allow-Methods',
                              'GET, POST, PATCH, DELETE, OPTIONS')
-        return response
+        return replicas.set_cookie(response)
 
     # Helper functions
 
-    def paginate(objects, request):
-        pg = request.args.get('page', 1, type=int)
-        if len(objects) == 0:
-            abort(404)
+    manufacturer_encoder = encoders[Manufacturer]
+    pedal_encoder = encoders[Pedal]
 
-        if pg > (len(objects)/20 + 1):
-            abort(404)
-        firstItem = 20 * (pg - 1)
-        lastItem = firstItem + 20
-        objects = [o.format() for o in objects]
-        current_page = objects[firstItem:lastItem]
+    def return_minimal(request):
+        prefer = request.headers.get('Prefer', '')
+        return (request.args.get('return') == 'minimal' or
+                'return=minimal' in prefer.replace(' ', '').split(','))
 
-        return current_page
+    def minimal_response(body):
+        response = jsonify(body)
+        response.headers['Preference-Applied'] = 'return=minimal'
+        return response
+
+    def row_response(body, row):
+        '''
+        A single row's response, with the row's version as its ETag, the
+        same validator PATCH checks If-Match against.
+        '''
+        response = json_response(body)
+        response.set_etag(row_etag(row))
+        return response.make_conditional(request)
+
+    def price_arg(request, name):
+        # nan and inf parse as floats but have no price in cents
+        price = request.args.get(name, type=float)
+        if price is not None and not math.isfinite(price):
+            abort(400)
+        return price
+
+    def pedal_filters(request):
+        filters = []
+        price_column = Pedal.new_price_cents
+        if request.args.get('price') == 'used':
+            price_column = Pedal.used_price_cents
+
+        pedal_type = request.args.get('pedal_type')
+        if pedal_type is not None:
+            filters.append(Pedal.pedal_type == pedal_type)
+
+        manufacturer_id = request.args.get('manufacturer_id', type=int)
+        if manufacturer_id is not None:
+            filters.append(Pedal.manufacturer_id == manufacturer_id)
+
+        min_price = price_arg(request, 'min_price')
+        if min_price is not None:
+            filters.append(price_column >= round(min_price * 100))
+
+        max_price = price_arg(request, 'max_price')
+        if max_price is not None:
+            filters.append(price_column <= round(max_price * 100))
+
+        return filters, price_column
+
+    def pedal_sort(request, price_column):
+        sort = request.args.get('sort', 'id')
+        descending = sort.startswith('-')
+        key = sort.lstrip('-')
+
+        if key == 'id':
+            return [Pedal.id], descending
+        if key == 'name':
+            return [Pedal.name, Pedal.id], descending
+        if key == 'price':
+            return [price_column, Pedal.id], descending
+        abort(400)
+
+    def parse_ids(ids):
+        try:
+            ids = [int(i) for i in ids.split(',') if i.strip()]
+        except ValueError:
+            abort(400)
+        if len(ids) == 0 or len(ids) > MAX_PAGE_SIZE:
+            abort(400)
+        return ids
 
     # Endpoint to handle GET requests for all Manufacturers
 
     @app.route('/manufacturers', methods=['GET'])
+    @query_budget(3)
+    @cached('manufacturers')
     def get_manufacturers():
-        manufacturer_objects = Manufacturer.query.order_by(
-            Manufacturer.id).all()
+        snapshot = catalog.get()
+        if snapshot is not None:
+            manufacturers = snapshot.all_manufacturers()
+        else:
+            manufacturers = manufacturer_encoder.query().order_by(
+                Manufacturer.id)
+
+        if uses_cursor(request):
+            current_page, next_cursor = paginate_keyset(
+                manufacturers, request, [Manufacturer.id],
+                format_page=manufacturer_encoder.rows)
+
+            return json_response({
+                'manufacturers': current_page,
+                'next_cursor': next_cursor,
+                'success': True
+            })
+
+        current_page, num_manufacturers = paginate(
+            manufacturers, request, Manufacturer,
+            format_page=manufacturer_encoder.rows)
+
+        return json_response({
+            'manufacturers': current_page,
+            'num_manufacturers': num_manufacturers,
+            'success': True
+        })
 
-        if len(manufacturer_objects) == 0:
-            abort(404)
+    # Endpoint to handle GET requests for a single manufacturer
 
-        current_page = paginate(manufacturer_objects, request)
+    @app.route('/manufacturers/<int:manufacturer_id>', methods=['GET'])
+    @query_budget(1)
+    def get_manufacturer(manufacturer_id):
+        snapshot = catalog.get()
+        if snapshot is not None:
+            manufacturer = snapshot.manufacturers.get(manufacturer_id)
+        else:
+            query = manufacturer_encoder.query(Manufacturer.row_version)
+            manufacturer = query.filter(
+                Manufacturer.id == manufacturer_id).first()
 
-        return jsonify({
-            'manufacturers': current_page,
-            'num_manufacturers': len(manufacturer_objects),
+        if manufacturer is None:
+            abort(404)
+
+        return row_response({
+            'manufacturer': manufacturer_encoder.row(manufacturer),
             'success': True
-        })
+        }, manufacturer)
 
     # Endpoint to handle GET requests for pedals by manufacturer
 
     @app.route('/manufacturers/<int:manufacturer_id>/pedals', methods=['GET'])
+    @query_budget(1)
+    @cached(manufacturer_pedals_key)
     def get_pedals_by_manufacturer(manufacturer_id):
-        pedals_by_manufacturer_objects = Pedal.query.filter(
-            Pedal.manufacturer_id == manufacturer_id).all()
-        manufacturer = Manufacturer.query.filter(
-            Manufacturer.id == manufacturer_id).first()
+        snapshot = catalog.get()
+        cursor_mode = uses_cursor(request)
+
+        if snapshot is not None:
+            manufacturer = snapshot.manufacturers.get(manufacturer_id)
+            if manufacturer is None:
+                abort(404)
+
+            pedals = snapshot.pedals_of(manufacturer_id)
+            if cursor_mode:
+                current_page, next_cursor = paginate_keyset(
+                    pedals, request, [Pedal.id])
+            else:
+                current_page, num_pedals = paginate(pedals, request)
+
+        # The manufacturer and its page of pedals come from one query
+        elif cursor_mode:
+            limit, sort, after = cursor_args(request, [Pedal.id])
+            manufacturer, _ = Manufacturer.with_pedal_page(
+                manufacturer_id, limit + 1,
+                after_id=after[0] if after else None)
+            if manufacturer is None:
+                abort(404)
+
+            current_page, next_cursor = keyset_page(
+                manufacturer.pedals, limit, sort, [Pedal.id],
+                format_page=pedal_encoder.rows)
+
+        else:
+            limit, offset = page_limits(request)
+            manufacturer, num_pedals = Manufacturer.with_pedal_page(
+                manufacturer_id, limit, offset)
+            if manufacturer is None:
+                abort(404)
+
+            page_bounds(request, num_pedals)
+            current_page = pedal_encoder.rows(manufacturer.pedals)
+
+        if cursor_mode:
+            return json_response({
+                'manufacturer_id': manufacturer_id,
+                'manufacturer_name': manufacturer.name,
+                'pedals': current_page,
+                'next_cursor': next_cursor,
+                'success': True
+            })
+
+        return json_response({
+            'manufacturer_id': manufacturer_id,
+            'manufacturer_name': manufacturer.name,
+            'pedals': current_page,
+            'num_pedals': num_pedals,
+            'success': True
+        })
 
-        if manufacturer is None:
-            abort(404)
+    # Endpoint to handle GET requests for pedals
+
+    @app.route('/pedals', methods=['GET'])
+    @query_budget(3)
+    @cached('pedals')
+    def get_pedals():
+        if 'ids' in request.args:
+            ids = parse_ids(request.args['ids'])
+            snapshot = catalog.get()
+            if snapshot is not None:
+                pedals = [snapshot.pedals.get(id) for id in sorted(set(ids))]
+                pedals = [pedal for pedal in pedals if pedal is not None]
+            else:
+                pedals = pedal_encoder.query().filter(
+                    Pedal.id.in_(ids)).order_by(Pedal.id).all()
+
+            if len(pedals) == 0:
+                abort(404)
+
+            return json_response({
+                'pedals': pedal_encoder.rows(pedals),
+                'num_pedals': len(pedals),
+                'success': True
+            })
+
+        filters, price_column = pedal_filters(request)
+        columns, descending = pedal_sort(request, price_column)
+        pedals = pedal_encoder.query(*columns).filter(*filters)
+
+        if uses_cursor(request):
+            current_page, next_cursor = paginate_keyset(
+                pedals, request, columns, descending,
+                format_page=pedal_encoder.rows)
+
+            return json_response({
+                'pedals': current_page,
+                'next_cursor': next_cursor,
+                'success': True
+            })
+
+        current_page, num_pedals = paginate(
+            pedals.order_by(*order_by_key(columns, descending)), request,
+            None if filters else Pedal, format_page=pedal_encoder.rows)
+
+        return json_response({
+            'pedals': current_page,
+            'num_pedals': num_pedals,
+            'success': True
+        })
+
+    # Endpoint to handle GET requests for a single pedal
 
-        manufacturer_name = manufacturer.name
+    @app.route('/pedals/<int:pedal_id>', methods=['GET'])
+    @query_budget(1)
+    def get_pedal(pedal_id):
+        snapshot = catalog.get()
+        if snapshot is not None:
+            pedal = snapshot.pedals.get(pedal_id)
+        else:
+            pedal = pedal_encoder.query(Pedal.row_version) \
+                .filter(Pedal.id == pedal_id).first()
 
-        if len(pedals_by_manufacturer_objects) == 0:
+        if pedal is None:
             abort(404)
 
-        current_page = paginate(pedals_by_manufacturer_objects, request)
+        return row_response({
+            'pedal': pedal_encoder.row(pedal),
+            'success': True
+        }, pedal)
 
-        return jsonify({
-            'manufacturer_id': manufacturer_id,
-            'manufacturer_name': manufacturer_name,
-            'pedals': current_page,
-            'num_pedals': len(pedals_by_manufacturer_objects),
+    # Endpoint to handle GET requests for searching pedals or manufacturers
+
+    @app.route('/search', methods=['GET'])
+    @query_budget(2)
+    @cached('manufacturers', 'pedals')
+    def search_catalog():
+        q = request.args.get('q', '')
+        kind = request.args.get('type', 'pedals')
+        models = {'pedals': Pedal, 'manufacturers': Manufacturer}
+
+        if kind not in models:
+            abort(400)
+
+        current_page, total = paginate(
+            search(models[kind], q), request,
+            format_page=encoders[models[kind]].rows)
+
+        return json_response({
+            kind: current_page,
+            'num_' + kind: total,
             'success': True
         })
 
+    # Endpoint to handle GET requests for a streamed export of the catalog
+
+    @app.route('/export', methods=['GET'])
+    @query_budget(2)
+    def export_catalog():
+        return export_response(request)
+
+    # Endpoint to handle GET requests for metrics in the Prometheus format
+
+    @app.route('/metrics', methods=['GET'])
+    @query_budget(0)
+    def get_metrics():
+        return metrics_response()
+
     # Endpoint to handle POST requests for new manufacturer
 
     @app.route('/manufacturers', methods=['POST'])
+    @query_budget(5)
     @requires_auth('post:manufacturers')
     def create_manufacturer(payload):
         body = request.get_json()
         name = body.get('name', None)
         website_link = body.get('website_link', None)
         try:
-            manufacturer = Manufacturer(name=name, website_link=website_link)
-            exists = Manufacturer.query.filter(
-                Manufacturer.name == name).one_or_none()
-            if exists is None:
-                manufacturer.insert()
-
-                manufacturers = Manufacturer.query.all()
-                current_page = paginate(manufacturers, request)
-
-                return jsonify({
-                    'created_manufacturer': manufacturer.id,
-                    'manufacturers': current_page,
-                    'num_manufacturers': len(manufacturers),
+            row = insert_returning(Manufacturer, {
+                'name': name,
+                'website_link': website_link
+            })
+
+            if return_minimal(request):
+                if row is None:
+                    return minimal_response({
+                        'created_manufacturer': None,
+                        'success': False
+                    })
+                return minimal_response({
+                    'created_manufacturer': row.id,
+                    'manufacturer': Manufacturer.format_row(row),
                     'success': True
                 })
-            else:
-                manufacturers = Manufacturer.query.all()
-                current_page = paginate(manufacturers, request)
-
-                return jsonify({
-                    'created_manufacturer': None,
-                    'manufacturers': current_page,
-                    'num_manufacturers': len(manufacturers),
-                    'success': False
-                })
+
+            manufacturers = Manufacturer.query.order_by(Manufacturer.id)
+            current_page, num_manufacturers = paginate(
+                manufacturers, request, Manufacturer)
+
+            return jsonify({
+                'created_manufacturer': row.id if row is not None else None,
+                'manufacturers': current_page,
+                'num_manufacturers': num_manufacturers,
+                'success': row is not None
+            })
         except Exception:
             abort(422)
 
     # Endpoint to handle POST requests for new pedal
 
     @app.route('/pedals', methods=['POST'])
+    @query_budget(5)
     @requires_auth('post:pedals')
     def create_pedals(payload):
         body = request.get_json()
@@ -134,142 +410,311 @@ def create_app(test_config=None):
         manufacturer_id = body.get('manufacturer_id', None)
 
         try:
-            pedal = Pedal(name=name, pedal_type=pedal_type,
-                          new_price=new_price, used_price=used_price,
-                          manufacturer_id=manufacturer_id)
-            exists = Pedal.query.filter(Pedal.name == name).one_or_none()
-            if exists is None:
-                pedal.insert()
-
-                pedals = Pedal.query.all()
-                current_page = paginate(pedals, request)
-
-                return jsonify({
-                    'created_pedal': pedal.id,
-                    'pedals': current_page,
-                    'num_pedals': len(pedals),
+            row = insert_returning(Pedal, {
+                'name': name,
+                'pedal_type': pedal_type,
+                'new_price': new_price,
+                'used_price': used_price,
+                'manufacturer_id': manufacturer_id
+            })
+
+            if return_minimal(request):
+                if row is None:
+                    return minimal_response({
+                        'created_pedal': None,
+                        'success': False
+                    })
+                return minimal_response({
+                    'created_pedal': row.id,
+                    'pedal': Pedal.format_row(row),
                     'success': True
                 })
-            else:
-                pedals = Pedal.query.all()
-                current_page = paginate(pedals, request)
-
-                return jsonify({
-                    'created_pedal': None,
-                    'pedals': current_page,
-                    'num_pedals': len(pedals),
-                    'success': False
-                })
+
+            pedals = Pedal.query.order_by(Pedal.id)
+            current_page, num_pedals = paginate(pedals, request, Pedal)
+
+            return jsonify({
+                'created_pedal': row.id if row is not None else None,
+                'pedals': current_page,
+                'num_pedals': num_pedals,
+                'success': row is not None
+            })
         except Exception:
             abort(422)
 
-    # Endpoint to handle PATCH requests for manufacturers
+    # Helper for bulk ingest endpoints
 
-    @app.route('/manufacturers/<int:manufacturer_id>', methods=['PATCH'])
+    def bulk_response(model, fields):
+        try:
+            results = ingest(model, fields, iter_records(request),
+                             batch_size(request))
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        statuses = [result['status'] for result in results]
+
+        return jsonify({
+            'results': results,
+            'num_created': statuses.count('created'),
+            'num_duplicates': statuses.count('duplicate'),
+            'num_invalid': statuses.count('invalid'),
+            'success': True
+        })
+
+    # Endpoint to handle bulk POST requests for new manufacturers
+
+    @app.route('/manufacturers/bulk', methods=['POST'])
+    # One INSERT per batch of records
+    @query_budget(None, repeats=None)
+    @requires_auth('post:manufacturers')
+    def bulk_create_manufacturers(payload):
+        return bulk_response(Manufacturer, ('name', 'website_link'))
+
+    # Endpoint to handle bulk POST requests for new pedals
+
+    @app.route('/pedals/bulk', methods=['POST'])
+    # One INSERT per batch of records
+    @query_budget(None, repeats=None)
+    @requires_auth('post:pedals')
+    def bulk_create_pedals(payload):
+        return bulk_response(Pedal, ('name', 'pedal_type', 'new_price',
+                                     'used_price', 'manufacturer_id'))
+
+    # Helper for batch update and delete endpoints
+
+    def batch_response(apply, done):
+        '''
+        Applies a JSON array (or NDJSON) of records with apply. Unless
+        atomic=false, the batch is all or nothing: if any record is not
+        done, everything is rolled back and the results come with a 422.
+        '''
+        atomic = request.args.get('atomic') != 'false'
+        records = list(itertools.islice(iter_records(request),
+                                        MAX_BULK_BATCH_SIZE + 1))
+        if not records or len(records) > MAX_BULK_BATCH_SIZE:
+            abort(400)
+
+        try:
+            results = apply(records, atomic)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        statuses = [result['status'] for result in results]
+        applied = not atomic or statuses.count(done) == len(statuses)
+        if applied:
+            db.session.commit()
+        else:
+            db.session.rollback()
+            for result in results:
+                if result['status'] == done:
+                    result['status'] = 'not_applied'
+
+        body = {
+            'results': results,
+            'num_' + done: statuses.count(done) if applied else 0,
+            'num_not_found': statuses.count('not_found'),
+            'num_invalid': statuses.count('invalid'),
+            'success': applied
+        }
+        if 'conflict' in statuses:
+            body['num_conflicts'] = statuses.count('conflict')
+        return jsonify(body), 200 if applied else 422
+
+    # Endpoint to handle batch PATCH requests for manufacturers
+
+    @app.route('/manufacturers', methods=['PATCH'])
+    # One UPDATE per distinct set of fields patched
+    @query_budget(None, repeats=None)
     @requires_auth('patch:manufacturers')
-    def update_manufacturers(payload, manufacturer_id):
-        body = request.get_json()
-        name = body.get('name', None)
-        website_link = body.get('website_link', None)
+    def batch_update_manufacturers(payload):
+        return batch_response(lambda records, atomic: patch_rows(
+            Manufacturer, ('name', 'website_link'), records, atomic),
+            'updated')
 
-        manufacturer = Manufacturer.query.filter(
-            Manufacturer.id == manufacturer_id).one_or_none()
+    # Endpoint to handle batch PATCH requests for pedals
 
-        if manufacturer is None:
+    @app.route('/pedals', methods=['PATCH'])
+    # One UPDATE per distinct set of fields patched
+    @query_budget(None, repeats=None)
+    @requires_auth('patch:pedals')
+    def batch_update_pedals(payload):
+        return batch_response(lambda records, atomic: patch_rows(
+            Pedal, ('name', 'pedal_type', 'new_price', 'used_price',
+                    'manufacturer_id'), records, atomic), 'updated')
+
+    # Endpoint to handle batch DELETE requests for manufacturers
+
+    @app.route('/manufacturers', methods=['DELETE'])
+    @query_budget(2)
+    @requires_auth('delete:manufacturers')
+    def batch_delete_manufacturers(payload):
+        return batch_response(lambda records, atomic: delete_rows(
+            Manufacturer, records, atomic), 'deleted')
+
+    # Endpoint to handle batch DELETE requests for pedals
+
+    @app.route('/pedals', methods=['DELETE'])
+    @query_budget(2)
+    @requires_auth('delete:pedals')
+    def batch_delete_pedals(payload):
+        return batch_response(lambda records, atomic: delete_rows(
+            Pedal, records, atomic), 'deleted')
+
+    # Helper for single item PATCH endpoints
+
+    def patch(model, id, fields):
+        '''
+        Sets the fields the JSON body has, among fields, on the row and
+        returns it. The body may also repeat the row's id. Values that are
+        the same as the row's aren't written. The response carries the
+        row's version as its ETag, and If-Match with an older one fails
+        with a 412.
+        '''
+        body = request.get_json()
+        try:
+            values = validate_changes(model.__table__, fields, body,
+                                      allowed=('id',))
+        except ValueError:
+            abort(422)
+        # A body echoed back from a GET may carry the id, but can't move it
+        if body.get('id', id) != id:
+            abort(422)
+
+        try:
+            row, _ = patch_returning(model, id, values, request.if_match)
+        except VersionConflict:
+            abort(412)
+        except SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+        if row is None:
             abort(404)
 
-        manufacturer.name = name
-        manufacturer.website_link = website_link
+        @after_this_request
+        def set_etag(response):
+            response.set_etag(row_etag(row))
+            return response
+        return row
+
+    # Endpoint to handle PATCH requests for manufacturers
+
+    @app.route('/manufacturers/<int:manufacturer_id>', methods=['PATCH'])
+    # Two more if the write races another and is tried again
+    @query_budget(8)
+    @requires_auth('patch:manufacturers')
+    def update_manufacturers(payload, manufacturer_id):
+        row = patch(Manufacturer, manufacturer_id, ('name', 'website_link'))
 
-        manufacturer.update()
+        if return_minimal(request):
+            return minimal_response({
+                'updated_manufacturer': row.id,
+                'manufacturer': Manufacturer.format_row(row),
+                'success': True
+            })
 
-        manufacturers = Manufacturer.query.all()
-        current_page = paginate(manufacturers, request)
+        manufacturers = Manufacturer.query.order_by(Manufacturer.id)
+        current_page, num_manufacturers = paginate(
+            manufacturers, request, Manufacturer)
 
         return jsonify({
-            'updated_manufacturer': manufacturer.id,
+            'updated_manufacturer': row.id,
             'manufacturers': current_page,
-            'num_manufacturers': len(manufacturers),
+            'num_manufacturers': num_manufacturers,
             'success': True
         })
 
     # Endpoint to handle PATCH requests for pedals
 
     @app.route('/pedals/<int:pedal_id>', methods=['PATCH'])
+    # Two more if the write races another and is tried again
+    @query_budget(8)
     @requires_auth('patch:pedals')
     def update_pedals(payload, pedal_id):
-        body = request.get_json()
-        name = body.get('name', None)
-        pedal_type = body.get('pedal_type', None)
-        new_price = body.get('new_price', None)
-        used_price = body.get('used_price', None)
-        manufacturer_id = body.get('manufacturer_id', None)
-
-        pedal = Pedal.query.filter(Pedal.id == pedal_id).one_or_none()
-
-        if pedal is None:
-            abort(404)
-
-        pedal.name = name
-        pedal.pedal_type = pedal_type
-        pedal.new_price = new_price
-        pedal.used_price = used_price
-        pedal.manufacturer_id = manufacturer_id
+        row = patch(Pedal, pedal_id, ('name', 'pedal_type', 'new_price',
+                                      'used_price', 'manufacturer_id'))
 
-        pedal.update()
+        if return_minimal(request):
+            return minimal_response({
+                'updated_pedal': row.id,
+                'pedal': Pedal.format_row(row),
+                'success': True
+            })
 
-        pedals = Pedal.query.all()
-        current_page = paginate(pedals, request)
+        pedals = Pedal.query.order_by(Pedal.id)
+        current_page, num_pedals = paginate(pedals, request, Pedal)
 
         return jsonify({
-            'updated_pedal': pedal.id,
+            'updated_pedal': row.id,
             'pedals': current_page,
-            'num_pedals': len(pedals),
+            'num_pedals': num_pedals,
             'success': True
         })
 
     # Endpoint to handle DELETE requests for manufacturers
 
     @app.route('/manufacturers/<int:manufacturer_id>', methods=['DELETE'])
+    @query_budget(5)
     @requires_auth('delete:manufacturers')
     def delete_manufacturer(payload, manufacturer_id):
-        manufacturer = Manufacturer.query.filter(
-            Manufacturer.id == manufacturer_id).one_or_none()
-        if manufacturer is None:
+        try:
+            row = delete_returning(Manufacturer, manufacturer_id)
+        except Exception:
+            abort(422)
+        if row is None:
             abort(404)
+
+        if return_minimal(request):
+            return minimal_response({
+                'deleted_manufacturer': manufacturer_id,
+                'success': True
+            })
+
         try:
-            manufacturer.delete()
-            manufacturers = Manufacturer.query.all()
-            current_page = paginate(manufacturers, request)
+            manufacturers = Manufacturer.query.order_by(Manufacturer.id)
+            current_page, num_manufacturers = paginate(
+                manufacturers, request, Manufacturer)
         except Exception:
             abort(422)
 
         return jsonify({
             'deleted_manufacturer': manufacturer_id,
             'manufacturers': current_page,
-            'num_manufacturers': len(manufacturers),
+            'num_manufacturers': num_manufacturers,
             'success': True
         })
 
     # Endpoint to handle DELETE requests for pedals
 
     @app.route('/pedals/<int:pedal_id>', methods=['DELETE'])
+    @query_budget(5)
     @requires_auth('delete:pedals')
     def delete_pedals(payload, pedal_id):
-        pedal = Pedal.query.filter(Pedal.id == pedal_id).one_or_none()
-        if pedal is None:
+        try:
+            row = delete_returning(Pedal, pedal_id)
+        except Exception:
+            abort(422)
+        if row is None:
             abort(404)
+
+        if return_minimal(request):
+            return minimal_response({
+                'deleted_pedal': pedal_id,
+                'success': True
+            })
+
         try:
-            pedal.delete()
-            pedals = Pedal.query.all()
-            current_page = paginate(pedals, request)
+            pedals = Pedal.query.order_by(Pedal.id)
+            current_page, num_pedals = paginate(pedals, request, Pedal)
         except Exception:
             abort(422)
 
         return jsonify({
             'deleted_pedal': pedal_id,
             'pedals': current_page,
-            'num_pedals': len(pedals),
+            'num_pedals': num_pedals,
             'success': True
         })
 
@@ -299,6 +744,14 @@ def create_app(test_config=None):
             'message': 'method not allowed'
         }), 405
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            'error': 412,
+            'success': False,
+            'message': 'precondition failed'
+        }), 412
+
     @app.errorhandler(422)
     def unprocessable_entity(error):
         return jsonify({
@@ -1,14 +1,33 @@
+import hashlib
 import json
+import logging
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from metrics import registry, timed
+from tracing import traced
 import os
 
 AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 ALGORITHMS = os.environ.get('ALGORITHMS')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
 
+# JWKS location and caching. JWKS_URL may point at a local file
+# (file:///path/jwks.json) or a stub server for testing.
+JWKS_URL = os.environ.get('JWKS_URL',
+                          f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_FETCH_TIMEOUT = float(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
+logger = logging.getLogger(__name__)
+
 # AuthError Exception
 
 
@@ -17,6 +36,176 @@ class AuthError(Exception):
         self.error = error
         self.status_code = status_code
 
+# Process-wide JWKS key store
+
+
+class JWKSKeyStore:
+    '''
+    Caches the RSA signing keys from the JWKS document by kid.
+
+    Keys are served from memory for `ttl` seconds. Once they go stale
+    they keep being served while a background thread refetches them,
+    and if that fetch fails the stale keys stay in use. An unknown kid
+    forces a refresh, but at most one fetch runs at a time and fetches
+    are never closer together than `min_refresh_interval` seconds.
+    '''
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL, timeout=JWKS_FETCH_TIMEOUT,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.min_refresh_interval = min_refresh_interval
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._lock = threading.Lock()
+
+    @traced('jwks')
+    @timed('jwks_fetch_duration_seconds')
+    def _fetch(self):
+        with urlopen(self.url, timeout=self.timeout) as key_url:
+            jwks = json.loads(key_url.read())
+
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        return keys
+
+    def _is_stale(self):
+        return (self._fetched_at is None or
+                time.monotonic() - self._fetched_at > self.ttl)
+
+    def refresh(self):
+        with self._lock:
+            # Another thread may have refreshed while we waited
+            now = time.monotonic()
+            if (self._keys and self._last_attempt is not None and
+                    now - self._last_attempt < self.min_refresh_interval):
+                return
+            self._last_attempt = now
+
+            try:
+                self._keys = self._fetch()
+                self._fetched_at = time.monotonic()
+            except Exception:
+                registry.inc('jwks_fetch_errors_total')
+                if not self._keys:
+                    raise AuthError('Unable to fetch signing keys', 503)
+                logger.warning('JWKS refresh from %s failed, serving '
+                               'stale keys', self.url, exc_info=True)
+
+    def _refresh_in_background(self):
+        if self._lock.locked():
+            return
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def get_key(self, kid):
+        if not self._keys:
+            self.refresh()
+        elif self._is_stale():
+            self._refresh_in_background()
+
+        rsa_key = self._keys.get(kid)
+        if rsa_key is None:
+            self.refresh()
+            rsa_key = self._keys.get(kid)
+        return rsa_key
+
+    def peek(self, kid):
+        '''Return the cached key for kid without triggering a fetch.'''
+        return self._keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+
+# Verified token cache
+
+
+class TokenCache:
+    '''
+    Bounded LRU of verified JWT payloads keyed by a digest of the token.
+
+    An entry is only served until the token's exp and only while the key
+    it was verified with is still the one published under its kid.
+    '''
+
+    def __init__(self, key_store, maxsize=TOKEN_CACHE_SIZE):
+        self.key_store = key_store
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        digest = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None:
+                payload, rsa_key = entry
+                if (payload['exp'] > time.time() and
+                        self.key_store.peek(rsa_key['kid']) == rsa_key):
+                    self._entries.move_to_end(digest)
+                    self.hits += 1
+                    return payload
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    def set(self, token, payload, rsa_key):
+        exp = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        digest = self.digest(token)
+        with self._lock:
+            self._entries[digest] = (payload, rsa_key)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+        }
+
+    def collect(self):
+        '''Metrics for the registry, see metrics.py.'''
+        yield 'token_cache_hits_total', (), self.hits
+        yield 'token_cache_misses_total', (), self.misses
+        yield 'token_cache_entries', (), len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+token_cache = TokenCache(jwks_store)
+registry.register('token_cache', token_cache.collect)
+
 # Get Authorization header from token
 
 
@@ -48,30 +237,26 @@ def check_permissions(permission, payload):
 # Decode and verify JWT
 
 
+@traced('auth')
+@timed('jwt_verify_duration_seconds')
 def verify_decode_jwt(token):
-    key_url = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    keys = json.loads(key_url.read())
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     unverified_header = jwt.get_unverified_header(token)
 
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError('No kid in header', 401)
 
-    for key in keys['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
 
     if rsa_key:
         try:
             payload = jwt.decode(token, rsa_key, algorithms=ALGORITHMS,
                                  audience=API_AUDIENCE,
                                  issuer='https://' + AUTH0_DOMAIN + '/')
+            token_cache.set(token, payload, rsa_key)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -0,0 +1,77 @@
+import argparse
+import json
+import sys
+
+'''
+Compare load benchmark runs
+
+Prints each route's p95 latency, requests per second and SQL
+statements per request in two runs from benchmarks.load, and exits with
+status 1 if any route's p95 got worse by more than the threshold, it
+ran more SQL, or it started failing.
+'''
+
+
+def change(base, new):
+    if not base or new is None:
+        return None
+    return (new - base) / base
+
+
+def regressions(base, new, threshold):
+    found = []
+    for name, stats in new['routes'].items():
+        before = base['routes'].get(name)
+        if before is None:
+            continue
+        slower = change(before['p95_ms'], stats['p95_ms'])
+        if slower is not None and slower > threshold:
+            found.append('{}: p95 {:+.0%}'.format(name, slower))
+        if (before['sql_per_request'] is not None and
+                stats['sql_per_request'] is not None and
+                stats['sql_per_request'] > before['sql_per_request']):
+            found.append('{}: {} SQL statements per request, was {}'.format(
+                name, stats['sql_per_request'], before['sql_per_request']))
+        if stats['errors'] > before['errors']:
+            found.append('{}: {} errors, was {}'.format(
+                name, stats['errors'], before['errors']))
+    return found
+
+
+def table(base, new):
+    lines = ['{:<32} {:>22} {:>16} {:>14}'.format(
+        'route', 'p95 ms', 'rps', 'sql')]
+    for name, stats in new['routes'].items():
+        before = base['routes'].get(name, {})
+        lines.append('{:<32} {:>22} {:>16} {:>14}'.format(
+            name,
+            '{} -> {}'.format(before.get('p95_ms'), stats['p95_ms']),
+            '{} -> {}'.format(before.get('rps'), stats['rps']),
+            '{} -> {}'.format(before.get('sql_per_request'),
+                              stats['sql_per_request'])))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare two load benchmark runs.')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='allowed p95 slowdown, default 0.1 (10%%)')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    print(table(base, new))
+    found = regressions(base, new, args.threshold)
+    if found:
+        print('\nRegressions:\n' + '\n'.join(found))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
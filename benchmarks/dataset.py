@@ -0,0 +1,182 @@
+import argparse
+import io
+import itertools
+import os
+import random
+import time
+from sqlalchemy import create_engine
+
+BENCHMARK_DATABASE_URL = os.environ.get('BENCHMARK_DATABASE_URL')
+SIZES = {'1k': 1000, '100k': 100000, '1M': 1000000}
+COPY_CHUNK = 50000
+
+# Weighted like the pedal types in pedalsdb.psql
+PEDAL_TYPES = [
+    ('Overdrive', 57), ('Distortion', 39), ('Fuzz', 27), ('Delay', 26),
+    ('Wah', 23), ('Reverb', 23), ('Phaser', 14), ('Compressor', 14),
+    ('Analog Delay', 14), ('Digital Delay', 12), ('Chorus', 11),
+    ('Looper', 10), ('Flanger', 10), ('Tremolo', 8), ('Noise Gate', 7),
+    ('Volume Pedal', 6), ('Octaver', 6), ('Boost', 6), ('Vibrato', 5),
+    ('Treble Booster', 2)
+]
+BRAND_WORDS = ['Analog', 'Black', 'Blue', 'Cosmic', 'Electro', 'Fuzz',
+               'Golden', 'Iron', 'Lunar', 'Mojo', 'Pedal', 'Red', 'Sonic',
+               'Stone', 'Tone', 'Vintage', 'Wave', 'Wolf']
+BRAND_SUFFIXES = ['Audio', 'Effects', 'Electronics', 'FX', 'Labs', 'Sound',
+                  'Works']
+MODEL_WORDS = ['Blaster', 'Bender', 'Drive', 'Echo', 'Fader', 'Glide',
+               'Hammer', 'King', 'Machine', 'Muff', 'Screamer', 'Shifter',
+               'Storm', 'Swell', 'Thunder', 'Vibe', 'Wizard']
+
+'''
+Synthetic catalogs
+
+Generates a catalog of any size with a long tail of manufacturers: a
+few make thousands of pedals and most make a handful, following a Zipf
+distribution. Rows are streamed into Postgres with COPY, replacing
+everything in the target database. Generation is seeded, so the same
+size and seed always give the same catalog.
+'''
+
+
+def price(cents):
+    return None if cents is None else '${:,.2f}'.format(cents / 100)
+
+
+def manufacturer_count(pedals):
+    return max(10, pedals // 50)
+
+
+def generate_manufacturers(count, rng):
+    for id in range(1, count + 1):
+        name = '{} {} {}'.format(rng.choice(BRAND_WORDS),
+                                 rng.choice(BRAND_SUFFIXES), id)
+        yield (id, name, 'https://www.example.com/{}'.format(id))
+
+
+def generate_pedals(count, manufacturers, rng, skew=1.1):
+    '''
+    Pedals in id order, grouped by manufacturer the way a catalog
+    entered one manufacturer at a time is.
+    '''
+    weights = [1 / rank ** skew for rank in range(1, manufacturers + 1)]
+    owners = sorted(rng.choices(range(1, manufacturers + 1),
+                                cum_weights=list(itertools.accumulate(
+                                    weights)), k=count))
+    types = [name for name, _ in PEDAL_TYPES]
+    type_weights = list(itertools.accumulate(
+        weight for _, weight in PEDAL_TYPES))
+
+    for id, manufacturer_id in enumerate(owners, 1):
+        name = '{} {} {}-{}'.format(
+            rng.choice(MODEL_WORDS), rng.choice(MODEL_WORDS),
+            rng.choice('ABCDEFGHJKMNPRSTVX'), id)
+        new_cents = None
+        if rng.random() > 0.2:
+            new_cents = int(rng.lognormvariate(9.5, 0.6))
+        used_cents = None
+        if rng.random() > 0.1:
+            used_cents = int((new_cents or rng.lognormvariate(9.5, 0.6)) *
+                             rng.uniform(0.5, 0.9))
+        yield (id, name, rng.choices(types, cum_weights=type_weights)[0],
+               price(new_cents), price(used_cents), manufacturer_id,
+               new_cents, used_cents)
+
+
+def copy_rows(cursor, table, columns, rows):
+    def line(row):
+        return '\t'.join('\\N' if value is None else str(value)
+                         for value in row) + '\n'
+
+    sql = 'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns))
+    while True:
+        chunk = ''.join(map(line, itertools.islice(rows, COPY_CHUNK)))
+        if not chunk:
+            break
+        cursor.copy_expert(sql, io.StringIO(chunk))
+
+
+def load(url, pedals, seed=0):
+    '''Replaces the catalog in the database at url with a synthetic one.'''
+    rng = random.Random(seed)
+    manufacturers = manufacturer_count(pedals)
+    engine = create_engine(url)
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            # Clearing the stored stamps keeps old ETags from matching
+            cursor.execute('TRUNCATE "Pedal", "Manufacturer", "VersionStamp" '
+                           'RESTART IDENTITY CASCADE')
+            cursor.execute('CREATE TEMP TABLE staged_manufacturers '
+                           '(id int, name text, website_link text) '
+                           'ON COMMIT DROP')
+            cursor.execute('CREATE TEMP TABLE staged_pedals '
+                           '(id int, name text, pedal_type text, '
+                           'new_price text, used_price text, '
+                           'manufacturer_id int, new_price_cents int, '
+                           'used_price_cents int) ON COMMIT DROP')
+
+            copy_rows(cursor, 'staged_manufacturers',
+                      ['id', 'name', 'website_link'],
+                      generate_manufacturers(manufacturers, rng))
+            copy_rows(cursor, 'staged_pedals',
+                      ['id', 'name', 'pedal_type', 'new_price',
+                       'used_price', 'manufacturer_id', 'new_price_cents',
+                       'used_price_cents'],
+                      generate_pedals(pedals, manufacturers, rng))
+
+            # Search vectors as the models build them
+            cursor.execute(
+                'INSERT INTO "Manufacturer" (id, name, website_link, '
+                'search_vector) SELECT id, name, website_link, '
+                "to_tsvector('simple', name) FROM staged_manufacturers")
+            cursor.execute(
+                'INSERT INTO "Pedal" (id, name, pedal_type, new_price, '
+                'used_price, manufacturer_id, new_price_cents, '
+                'used_price_cents, search_vector) SELECT id, name, '
+                'pedal_type, new_price, used_price, manufacturer_id, '
+                'new_price_cents, used_price_cents, '
+                "to_tsvector('simple', concat_ws(' ', name, pedal_type)) "
+                'FROM staged_pedals')
+            for table in ('Manufacturer', 'Pedal'):
+                cursor.execute(
+                    "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                    'GREATEST(max(id), 1)) FROM "{0}"'.format(table))
+        connection.commit()
+
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE "Manufacturer", "Pedal"')
+    finally:
+        connection.close()
+        engine.dispose()
+    return manufacturers
+
+
+def size_arg(value):
+    if value in SIZES:
+        return SIZES[value]
+    return int(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replace the catalog with a synthetic one.')
+    parser.add_argument('--size', type=size_arg, default='100k',
+                        help='pedals: 1k, 100k, 1M or a number')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', default=BENCHMARK_DATABASE_URL,
+                        help='defaults to BENCHMARK_DATABASE_URL')
+    args = parser.parse_args()
+    if not args.database:
+        parser.error('set --database or BENCHMARK_DATABASE_URL; '
+                     'everything in it is replaced')
+
+    start = time.perf_counter()
+    manufacturers = load(args.database, args.size, args.seed)
+    print('Loaded {} pedals from {} manufacturers in {:.1f}s'.format(
+        args.size, manufacturers, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
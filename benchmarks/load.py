@@ -0,0 +1,526 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+from sqlalchemy import create_engine, event, text
+from benchmarks.dataset import (BENCHMARK_DATABASE_URL, MODEL_WORDS,
+                                PEDAL_TYPES, load, size_arg)
+from benchmarks.tokens import LocalIssuer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+'''
+Load benchmark
+
+Starts the app under gunicorn against a benchmark database, with a
+local token issuer standing in for Auth0, and drives each route in turn
+from concurrent keep-alive clients. Reports latency percentiles,
+requests per second, errors and response cache hits per route, plus
+the SQL statements each route runs, measured separately in-process so
+the count doesn't depend on which worker served a request:
+
+    python -m benchmarks.load --database URL --size 100k \\
+        --output results.json
+
+Runs can be compared with python -m benchmarks.compare.
+'''
+
+Scenario = namedtuple('Scenario', 'name method build auth')
+Catalog = namedtuple('Catalog', 'pedals manufacturers')
+
+
+class State:
+    '''Rows created by the write scenarios, for the ones after them.'''
+
+    def __init__(self):
+        self.created = {'manufacturers': [], 'pedals': []}
+        self.counter = 0
+        self._lock = threading.Lock()
+
+    def unique(self):
+        with self._lock:
+            self.counter += 1
+            return '{}-{}'.format(os.getpid(), self.counter)
+
+    def add(self, kind, id, body):
+        with self._lock:
+            self.created[kind].append((id, body))
+
+    def pick(self, kind, rng):
+        with self._lock:
+            rows = self.created[kind]
+            return rows[rng.randrange(len(rows))] if rows else None
+
+    def pop(self, kind):
+        with self._lock:
+            rows = self.created[kind]
+            return rows.pop() if rows else None
+
+    def sample(self, kind, rng, k):
+        with self._lock:
+            rows = self.created[kind]
+            return rng.sample(rows, min(k, len(rows)))
+
+    def pop_many(self, kind, k):
+        with self._lock:
+            rows = self.created[kind]
+            popped = rows[-k:]
+            del rows[-k:]
+            return popped
+
+
+def pedal_body(state, rng, catalog):
+    cents = rng.randint(2000, 50000)
+    return {
+        'name': 'Benchmark Pedal ' + state.unique(),
+        'pedal_type': rng.choice(PEDAL_TYPES)[0],
+        'new_price': '${:,.2f}'.format(cents / 100),
+        'used_price': '${:,.2f}'.format(cents * 0.7 / 100),
+        'manufacturer_id': rng.randint(1, catalog.manufacturers)
+    }
+
+
+def manufacturer_body(state):
+    return {
+        'name': 'Benchmark Audio ' + state.unique(),
+        'website_link': 'https://www.example.com/benchmark'
+    }
+
+
+def scenarios(catalog):
+    '''
+    Every route in app.py. Each build returns (path, JSON body) for one
+    request, or None when there is nothing to do. Writes run after the
+    reads, and each write route works on rows an earlier one created.
+    '''
+    pedal_pages = max(1, min(catalog.pedals // 20, 50))
+    manufacturer_pages = max(1, min(catalog.manufacturers // 20, 50))
+    words = MODEL_WORDS + [name for name, _ in PEDAL_TYPES]
+
+    def created(kind, path, body=None):
+        def build(rng, state):
+            row = state.pick(kind, rng)
+            if row is None:
+                return None
+            return path.format(row[0]), body(row[1]) if body else None
+        return build
+
+    def deleted(kind, path):
+        def build(rng, state):
+            row = state.pop(kind)
+            return None if row is None else (path.format(row[0]), None)
+        return build
+
+    def price_refresh(rng, state):
+        rows = state.sample('pedals', rng, 20)
+        if not rows:
+            return None
+        return '/pedals?atomic=false', [
+            {'id': id, 'used_price': '${}.00'.format(rng.randint(20, 400))}
+            for id, _ in rows]
+
+    def website_refresh(rng, state):
+        rows = state.sample('manufacturers', rng, 10)
+        if not rows:
+            return None
+        return '/manufacturers?atomic=false', [
+            {'id': id, 'website_link': 'https://example.org/{}'.format(
+                rng.randint(1, 1000))}
+            for id, _ in rows]
+
+    def batch_deleted(kind, path):
+        def build(rng, state):
+            rows = state.pop_many(kind, 10)
+            return (path, [id for id, _ in rows]) if rows else None
+        return build
+
+    return [
+        Scenario('GET /manufacturers', 'GET', lambda rng, state: (
+            '/manufacturers?page={}'.format(
+                rng.randint(1, manufacturer_pages)), None), False),
+        Scenario('GET /manufacturers/<id>', 'GET', lambda rng, state: (
+            '/manufacturers/{}'.format(rng.randint(1, catalog.manufacturers)),
+            None), False),
+        Scenario('GET /manufacturers/<id>/pedals', 'GET',
+                 lambda rng, state: ('/manufacturers/{}/pedals'.format(
+                     rng.randint(1, catalog.manufacturers)), None), False),
+        Scenario('GET /pedals', 'GET', lambda rng, state: (
+            '/pedals?page={}'.format(rng.randint(1, pedal_pages)), None),
+            False),
+        Scenario('GET /pedals?filters', 'GET', lambda rng, state: (
+            '/pedals?pedal_type={}&max_price={}&sort=price'.format(
+                rng.choice(PEDAL_TYPES)[0].replace(' ', '+'),
+                rng.choice([50, 100, 200, 500])), None), False),
+        Scenario('GET /pedals?ids', 'GET', lambda rng, state: (
+            '/pedals?ids=' + ','.join(
+                str(rng.randint(1, catalog.pedals)) for _ in range(20)),
+            None), False),
+        Scenario('GET /pedals/<id>', 'GET', lambda rng, state: (
+            '/pedals/{}'.format(rng.randint(1, catalog.pedals)), None),
+            False),
+        Scenario('GET /search', 'GET', lambda rng, state: (
+            '/search?q={}'.format(rng.choice(words).replace(' ', '+')),
+            None), False),
+        Scenario('GET /export', 'GET', lambda rng, state: (
+            '/export?type=manufacturers', None), False),
+        Scenario('GET /metrics', 'GET', lambda rng, state: (
+            '/metrics', None), False),
+        Scenario('POST /manufacturers', 'POST', lambda rng, state: (
+            '/manufacturers?return=minimal', manufacturer_body(state)),
+            True),
+        Scenario('POST /pedals', 'POST', lambda rng, state: (
+            '/pedals?return=minimal', pedal_body(state, rng, catalog)),
+            True),
+        Scenario('POST /manufacturers/bulk', 'POST', lambda rng, state: (
+            '/manufacturers/bulk',
+            [manufacturer_body(state) for _ in range(10)]), True),
+        Scenario('POST /pedals/bulk', 'POST', lambda rng, state: (
+            '/pedals/bulk',
+            [pedal_body(state, rng, catalog) for _ in range(10)]), True),
+        Scenario('PATCH /manufacturers/<id>', 'PATCH', created(
+            'manufacturers', '/manufacturers/{}',
+            lambda body: dict(body, website_link='https://example.org/')),
+            True),
+        Scenario('PATCH /pedals/<id>', 'PATCH', created(
+            'pedals', '/pedals/{}',
+            lambda body: dict(body, used_price='$12.34')), True),
+        Scenario('PATCH /manufacturers', 'PATCH', website_refresh, True),
+        Scenario('PATCH /pedals', 'PATCH', price_refresh, True),
+        Scenario('DELETE /pedals/<id>', 'DELETE', deleted(
+            'pedals', '/pedals/{}'), True),
+        Scenario('DELETE /pedals', 'DELETE', batch_deleted(
+            'pedals', '/pedals?atomic=false'), True),
+        Scenario('DELETE /manufacturers/<id>', 'DELETE', deleted(
+            'manufacturers', '/manufacturers/{}'), True),
+        Scenario('DELETE /manufacturers', 'DELETE', batch_deleted(
+            'manufacturers', '/manufacturers?atomic=false'), True),
+    ]
+
+
+def remember_created(state, path, body, data):
+    '''Keeps the rows a POST made, so PATCH and DELETE have targets.'''
+    if body is None or not isinstance(data, dict):
+        return
+    if path.endswith('/bulk'):
+        kind = path.split('/')[1]
+        for result in data.get('results', []):
+            if result['status'] == 'created':
+                state.add(kind, result['id'], body[result['index']])
+    elif data.get('created_manufacturer'):
+        state.add('manufacturers', data['created_manufacturer'], body)
+    elif data.get('created_pedal'):
+        state.add('pedals', data['created_pedal'], body)
+
+# Drive a running server
+
+
+class Client:
+    '''One keep-alive HTTP connection.'''
+
+    def __init__(self, url, token=None):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.token = token
+        self.connection = None
+
+    def request(self, method, path, body=None, auth=False):
+        headers = {'Accept-Encoding': 'identity'}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        if auth:
+            headers['Authorization'] = 'Bearer ' + self.token
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(
+                    self.host, self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body, headers)
+                response = self.connection.getresponse()
+                return response, response.read()
+            except (http.client.HTTPException, OSError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(len(ordered) * fraction + 0.5)
+                                      - 1))
+    return round(ordered[index] * 1000, 3)
+
+
+def drive(scenario, url, token, state, concurrency, duration, warmup,
+          seed):
+    '''Runs scenario from concurrency clients and returns its stats.'''
+    latencies = []
+    counts = {'requests': 0, 'errors': 0, 'client_errors': 0,
+              'cache_hits': 0, 'skipped': 0}
+    lock = threading.Lock()
+    start = time.monotonic()
+    measure_from = start + warmup
+    stop = measure_from + duration
+
+    def worker(n):
+        rng = random.Random(seed * 1000 + n)
+        client = Client(url, token)
+        mine = []
+        mine_counts = dict.fromkeys(counts, 0)
+        while True:
+            now = time.monotonic()
+            if now >= stop:
+                break
+            request = scenario.build(rng, state)
+            if request is None:
+                mine_counts['skipped'] += 1
+                time.sleep(0.01)
+                continue
+            path, body = request
+            begin = time.perf_counter()
+            try:
+                response, data = client.request(scenario.method, path, body,
+                                                scenario.auth)
+                status = response.status
+            except (http.client.HTTPException, OSError):
+                response, data, status = None, b'', 599
+            elapsed = time.perf_counter() - begin
+            if status == 200 and scenario.method == 'POST':
+                remember_created(state, path, body, json.loads(data))
+            if now < measure_from:
+                continue
+            mine.append(elapsed)
+            mine_counts['requests'] += 1
+            if status >= 500:
+                mine_counts['errors'] += 1
+            elif status >= 400:
+                mine_counts['client_errors'] += 1
+            if response is not None and response.getheader(
+                    'X-Cache') == 'HIT':
+                mine_counts['cache_hits'] += 1
+        with lock:
+            latencies.extend(mine)
+            for key, value in mine_counts.items():
+                counts[key] += value
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return dict(counts, **{
+        'rps': round(counts['requests'] / duration, 1),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': percentile(latencies, 1.0)
+    })
+
+# Count SQL per route in-process
+
+
+def profile_sql(scenarios, state, token, samples, seed):
+    '''
+    Runs each scenario samples times through the Flask test client
+    and counts statements on the engine. The response cache is cleared
+    before every request, so the counts are the view's own.
+    '''
+    from app import app
+    from cache import response_cache
+    from models import db
+
+    client = app.test_client()
+    with app.app_context():
+        engine = db.get_engine()
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    rng = random.Random(seed)
+    profile = {}
+    try:
+        for scenario in scenarios:
+            runs = []
+            for _ in range(samples):
+                request = scenario.build(rng, state)
+                if request is None:
+                    continue
+                path, body = request
+                response_cache.clear()
+                del statements[:]
+                headers = {}
+                if scenario.auth:
+                    headers['Authorization'] = 'Bearer ' + token
+                response = client.open(path, method=scenario.method,
+                                       json=body, headers=headers)
+                # Streamed bodies run their queries as they're read
+                response.get_data()
+                response.close()
+                runs.append(len(statements))
+                if response.status_code == 200 and body is not None:
+                    remember_created(state, path, body, response.get_json())
+            profile[scenario.name] = (
+                round(sum(runs) / len(runs), 2) if runs else None)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return profile
+
+# Run the app under gunicorn
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Server:
+    '''gunicorn serving app:app on a free local port.'''
+
+    def __init__(self, env, workers):
+        self.port = free_port()
+        self.url = 'http://127.0.0.1:{}'.format(self.port)
+        self.process = subprocess.Popen(
+            # gunicorn 20.0 has no __main__ for python -m
+            [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; '
+             'run()', '--workers', str(workers),
+             '--bind', '127.0.0.1:{}'.format(self.port), '--log-level',
+             'warning', 'app:app'],
+            cwd=ROOT, env=dict(os.environ, **env))
+
+    def wait(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('gunicorn exited')
+            try:
+                Client(self.url).request('GET', '/pedals?limit=1')
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('gunicorn did not start')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(10)
+
+
+def catalog_size(url):
+    engine = create_engine(url)
+    try:
+        with engine.connect() as connection:
+            return Catalog(
+                connection.scalar(text('SELECT max(id) FROM "Pedal"')),
+                connection.scalar(text(
+                    'SELECT max(id) FROM "Manufacturer"')))
+    finally:
+        engine.dispose()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Drive every route and report latency and SQL.')
+    parser.add_argument('--database', default=BENCHMARK_DATABASE_URL,
+                        help='defaults to BENCHMARK_DATABASE_URL')
+    parser.add_argument('--size', type=size_arg,
+                        help='load a synthetic catalog of this many '
+                        'pedals first (1k, 100k, 1M), replacing the '
+                        'database')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds measured per route')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds per route before measuring')
+    parser.add_argument('--routes', default='',
+                        help='only run routes whose name contains this; '
+                        'PATCH and DELETE need the POST routes to make '
+                        'rows first')
+    parser.add_argument('--sql-samples', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file, default stdout')
+    args = parser.parse_args()
+    if not args.database:
+        parser.error('set --database or BENCHMARK_DATABASE_URL')
+
+    if args.size:
+        load(args.database, args.size, args.seed)
+    catalog = catalog_size(args.database)
+    selected = [scenario for scenario in scenarios(catalog)
+                if args.routes in scenario.name]
+
+    with tempfile.TemporaryDirectory() as directory:
+        issuer = LocalIssuer(directory)
+        token = issuer.token()
+        env = dict(issuer.env(), DATABASE_URL_LIVE=args.database)
+        os.environ.update(env)
+
+        state = State()
+        server = Server(env, args.workers)
+        try:
+            server.wait()
+            routes = {}
+            for scenario in selected:
+                print('Running {}'.format(scenario.name), file=sys.stderr)
+                routes[scenario.name] = drive(
+                    scenario, server.url, token, state, args.concurrency,
+                    args.duration, args.warmup, args.seed)
+        finally:
+            server.stop()
+
+        # The same state, so names created here don't collide
+        sql = profile_sql(selected, state, token, args.sql_samples,
+                          args.seed)
+
+    for name, stats in routes.items():
+        stats['sql_per_request'] = sql.get(name)
+
+    report = {
+        'started': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'catalog': catalog._asdict(),
+        'config': {
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'seed': args.seed
+        },
+        'routes': routes
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import timeit
+from flask import jsonify
+from app import create_app
+from models import db, Pedal
+from serializer import encoders, json_response
+
+'''
+Serializer microbenchmark
+
+Times one page of pedals serialized the old way (ORM instances, then
+format() dicts, then jsonify) against column tuples encoded by the
+per-model encoder. Runs against DATABASE_URL:
+
+    python -m benchmarks.serializer --rows 1000 --number 200
+
+"query + serialize" includes the SELECT and, for the ORM path, building
+the instances; "serialize only" times encoding rows already fetched.
+'''
+
+
+def orm_body(pedals):
+    return jsonify({
+        'pedals': [pedal.format() for pedal in pedals],
+        'success': True
+    }).data
+
+
+def tuple_body(rows):
+    return json_response({
+        'pedals': encoders[Pedal].rows(rows),
+        'success': True
+    }).data
+
+
+def best_of(function, number, repeat):
+    return min(timeit.repeat(function, number=number,
+                             repeat=repeat)) / number
+
+
+def report(label, orm_time, tuple_time):
+    print('{:<20} orm {:9.1f} us  tuple {:9.1f} us  {:5.2f}x'.format(
+        label, orm_time * 1e6, tuple_time * 1e6, orm_time / tuple_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--number', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.test_request_context():
+        def orm_query():
+            pedals = Pedal.query.order_by(Pedal.id).limit(args.rows).all()
+            body = orm_body(pedals)
+            db.session.remove()
+            return body
+
+        def tuple_query():
+            rows = encoders[Pedal].query().order_by(Pedal.id).limit(
+                args.rows).all()
+            body = tuple_body(rows)
+            db.session.remove()
+            return body
+
+        pedals = Pedal.query.order_by(Pedal.id).limit(args.rows).all()
+        rows = encoders[Pedal].query().order_by(Pedal.id).limit(
+            args.rows).all()
+        if orm_body(pedals) != tuple_body(rows):
+            raise SystemExit('Bodies differ, not benchmarking')
+
+        print('{} pedals per page, best of {} x {}'.format(
+            len(rows), args.repeat, args.number))
+        report('serialize only',
+               best_of(lambda: orm_body(pedals), args.number, args.repeat),
+               best_of(lambda: tuple_body(rows), args.number, args.repeat))
+        report('query + serialize',
+               best_of(orm_query, args.number, args.repeat),
+               best_of(tuple_query, args.number, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
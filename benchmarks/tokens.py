@@ -0,0 +1,84 @@
+import base64
+import json
+import os
+import time
+from jose import jwt
+
+PERMISSIONS = [
+    'post:manufacturers', 'patch:manufacturers', 'delete:manufacturers',
+    'post:pedals', 'patch:pedals', 'delete:pedals'
+]
+
+'''
+Local token issuer
+
+A stand-in for Auth0 so the benchmarks can exercise the authenticated
+routes offline. It makes an RSA key, writes its public half as a JWKS
+file that auth.py reads through JWKS_URL=file://..., and signs tokens
+with it.
+'''
+
+
+def generate_key():
+    '''Returns a 2048-bit RSA key as (private PEM, n, e).'''
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+    except ImportError:
+        # pycryptodome, which python-jose-cryptodome depends on
+        from Crypto.PublicKey import RSA
+        key = RSA.generate(2048)
+        return key.exportKey().decode(), key.n, key.e
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption()).decode()
+    numbers = key.public_key().public_numbers()
+    return pem, numbers.n, numbers.e
+
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class LocalIssuer:
+    '''Signs tokens the app accepts once run with env().'''
+
+    def __init__(self, directory, domain='pedalsdb-benchmark.local',
+                 audience='pedalsdb-benchmark', kid='benchmark'):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        self.key, n, e = generate_key()
+        self.jwks_path = os.path.join(directory, 'jwks.json')
+        with open(self.jwks_path, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA',
+                'kid': kid,
+                'use': 'sig',
+                'alg': 'RS256',
+                'n': base64url_uint(n),
+                'e': base64url_uint(e)
+            }]}, f)
+
+    def env(self):
+        return {
+            'JWKS_URL': 'file://' + os.path.abspath(self.jwks_path),
+            'AUTH0_DOMAIN': self.domain,
+            'API_AUDIENCE': self.audience,
+            'ALGORITHMS': 'RS256'
+        }
+
+    def token(self, permissions=PERMISSIONS, ttl=3600):
+        now = int(time.time())
+        return jwt.encode({
+            'iss': 'https://{}/'.format(self.domain),
+            'sub': 'benchmark|1',
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + ttl,
+            'permissions': list(permissions)
+        }, self.key, algorithm='RS256', headers={'kid': self.kid})
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+from collections import Counter
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from metrics import registry
+
+# QUERY_BUDGETS=strict raises when a request goes over its budget, report
+# (default) logs it; debug and testing apps are always strict
+QUERY_BUDGETS = os.environ.get('QUERY_BUDGETS', 'report')
+DEFAULT_QUERY_BUDGET = int(os.environ.get('DEFAULT_QUERY_BUDGET', 10))
+QUERY_REPEAT_LIMIT = int(os.environ.get('QUERY_REPEAT_LIMIT', 3))
+
+logger = logging.getLogger('pedalsdb.query_budgets')
+
+'''
+Query budgets
+
+Each route declares the most SQL statements a request to it may run,
+next to the route, with @query_budget. Statements are counted from
+engine events, along with how often the same statement text repeats,
+since a statement run once per row is the shape of an N+1 query. Routes
+that don't declare a budget get DEFAULT_QUERY_BUDGET. Bookkeeping
+statements that aren't part of the route's work, like the replica
+position checks and the change NOTIFYs, are marked with
+execution_options(budgeted=False).
+
+A request over its budget or repeat limit raises QueryBudgetExceeded
+when the app is in debug or testing mode or QUERY_BUDGETS is strict, and
+is logged otherwise. Either way every request's statement count goes
+into the http_request_sql_statements histogram on /metrics.
+'''
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+def query_budget(statements, repeats=QUERY_REPEAT_LIMIT):
+    '''
+    Decorates a view, below @app.route, with the most statements a
+    request may run and the most times any one statement may run in it.
+    None means no limit, for routes that run a statement per batch of
+    input.
+    '''
+    def decorator(f):
+        f.query_budget = (statements, repeats)
+        return f
+    return decorator
+
+
+class StatementCounter:
+    '''The statements run by one request.'''
+
+    def __init__(self, method, rule, budget, repeats):
+        self.route = '{} {}'.format(method, rule)
+        self.labels = (('method', method), ('route', rule))
+        self.budget = budget
+        self.repeats = repeats
+        self.statements = Counter()
+
+    @property
+    def total(self):
+        return sum(self.statements.values())
+
+    def problems(self):
+        found = []
+        total = self.total
+        if self.budget is not None and total > self.budget:
+            found.append('{} SQL statements, over its budget of {}'.format(
+                total, self.budget))
+        if self.repeats is not None and self.statements:
+            statement, count = self.statements.most_common(1)[0]
+            if count > self.repeats:
+                found.append('the same statement {} times, over the limit '
+                             'of {} (N+1?): {}'.format(
+                                 count, self.repeats,
+                                 ' '.join(statement.split())))
+        return found
+
+
+_current = threading.local()
+
+
+def current_counter():
+    return getattr(_current, 'counter', None)
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    counter = current_counter()
+    if counter is None:
+        return
+    if context is None or context.execution_options.get('budgeted', True):
+        counter.statements[statement] += 1
+
+# Check budgets from Flask hooks
+
+
+def strict():
+    return (QUERY_BUDGETS == 'strict' or current_app.debug or
+            current_app.testing)
+
+
+def start_request():
+    _current.counter = None
+    rule = request.url_rule
+    if rule is None:
+        return
+    view = current_app.view_functions.get(request.endpoint)
+    statements, repeats = getattr(
+        view, 'query_budget', (DEFAULT_QUERY_BUDGET, QUERY_REPEAT_LIMIT))
+    _current.counter = StatementCounter(request.method, rule.rule,
+                                        statements, repeats)
+
+
+def check(counter, raise_errors):
+    registry.observe('http_request_sql_statements', counter.total,
+                     counter.labels)
+    problems = counter.problems()
+    if not problems:
+        return
+    registry.inc('query_budget_exceeded_total', counter.labels)
+    message = '{} ran {}'.format(counter.route, '; and '.join(problems))
+    if raise_errors:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def finish_request(response):
+    counter = current_counter()
+    if counter is None:
+        return response
+
+    # Streamed bodies run their queries after this, so they are counted
+    # until the response is closed and can only be logged
+    if response.is_streamed:
+        def closed():
+            _current.counter = None
+            check(counter, False)
+        response.call_on_close(closed)
+        return response
+
+    _current.counter = None
+    check(counter, strict())
+    return response
+
+
+def enforce_budgets(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,291 @@
+import json
+import os
+from flask import abort
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+from models import (db, mark_changed, Manufacturer, delete_many_returning,
+                    update_many_returning)
+
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 500))
+MAX_BULK_BATCH_SIZE = 5000
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson',
+                    'application/jsonl')
+
+# Read records from a request
+
+
+def iter_records(request):
+    '''
+    Yields records from either a JSON array body or an NDJSON body. NDJSON
+    is read from the request stream line by line, so the body is never
+    held in memory as a whole. Lines that are not valid JSON are yielded
+    as None so they can be reported per row.
+    '''
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+    else:
+        body = request.get_json()
+        if not isinstance(body, list):
+            abort(400)
+        for record in body:
+            yield record
+
+
+def batch_size(request):
+    size = request.args.get('batch_size', BULK_BATCH_SIZE, type=int)
+    return max(1, min(size, MAX_BULK_BATCH_SIZE))
+
+
+def batched(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Validate a record against the table's columns
+
+
+def validate_value(table, field, value):
+    column = table.c[field]
+    if value is None:
+        if not column.nullable or field == 'name':
+            raise ValueError('missing {}'.format(field))
+    elif (not isinstance(value, column.type.python_type) or
+          isinstance(value, bool)):
+        raise ValueError('invalid {}'.format(field))
+    elif (getattr(column.type, 'length', None) and
+          len(value) > column.type.length):
+        raise ValueError('{} is too long'.format(field))
+    return value
+
+
+def validate(table, fields, record):
+    if not isinstance(record, dict):
+        raise ValueError('record is not a JSON object')
+
+    return {field: validate_value(table, field, record.get(field, None))
+            for field in fields}
+
+
+def validate_id(id):
+    if not isinstance(id, int) or isinstance(id, bool) or id < 1:
+        raise ValueError('invalid id')
+    return id
+
+
+def validate_changes(table, fields, record, allowed=()):
+    '''
+    Checks an object with some of fields, and any of allowed, and returns
+    the fields it sets. Fields that aren't in the object are left out.
+    '''
+    if not isinstance(record, dict):
+        raise ValueError('record is not a JSON object')
+
+    unknown = sorted(set(record) - set(fields) - set(allowed))
+    if unknown:
+        raise ValueError('unknown field {}'.format(unknown[0]))
+    return {field: validate_value(table, field, record[field])
+            for field in fields if field in record}
+
+
+def validate_patch(table, fields, record):
+    '''
+    Checks a patch, an object with an id and some of fields, and returns
+    the id and the fields to set.
+    '''
+    if not isinstance(record, dict):
+        raise ValueError('record is not a JSON object')
+
+    id = validate_id(record.get('id'))
+    values = validate_changes(table, fields, record, allowed=('id',))
+    if not values:
+        raise ValueError('nothing to update')
+    return id, values
+
+# Check the manufacturers records refer to with one query
+
+
+def reject_unknown_manufacturers(pending, results):
+    '''
+    Marks the records in pending, a dict of (index, values), that name a
+    manufacturer_id that doesn't exist as invalid and drops them.
+    '''
+    manufacturer_ids = {values['manufacturer_id']
+                        for _, values in pending.values()
+                        if 'manufacturer_id' in values}
+    if not manufacturer_ids:
+        return
+    known = {row.id for row in db.session.query(Manufacturer.id)
+             .filter(Manufacturer.id.in_(manufacturer_ids))}
+    for key, (index, values) in list(pending.items()):
+        if ('manufacturer_id' in values and
+                values['manufacturer_id'] not in known):
+            results[index].update(status='invalid',
+                                  error='unknown manufacturer_id')
+            del pending[key]
+
+# Insert records in batches within a single transaction
+
+
+def ingest(model, fields, records, size):
+    '''
+    Validates and inserts records, size at a time, in one transaction.
+    Each batch is written with a single multi-row INSERT ... ON CONFLICT
+    DO NOTHING, and records whose unique key already exists are reported
+    as duplicates. Returns a status per record in input order. The caller
+    commits or rolls back.
+    '''
+    table = model.__table__
+    key_columns = [table.c[field] for field in model.unique_key]
+    results = []
+
+    for batch in batched(records, size):
+        offset = len(results)
+        results.extend({'index': offset + i} for i in range(len(batch)))
+
+        pending = {}
+        for i, record in enumerate(batch):
+            try:
+                values = validate(table, fields, record)
+            except ValueError as error:
+                results[offset + i].update(status='invalid',
+                                           error=str(error))
+                continue
+            key = tuple(values[field] for field in model.unique_key)
+            if key in pending:
+                results[offset + i].update(status='duplicate')
+            else:
+                pending[key] = (offset + i, values)
+
+        if 'manufacturer_id' in fields:
+            reject_unknown_manufacturers(pending, results)
+
+        if pending:
+            inserted = db.session.execute(
+                insert(table)
+                .values([model.prepare_values(values)
+                         for _, values in pending.values()])
+                .on_conflict_do_nothing(index_elements=model.unique_key)
+                .returning(table.c.id, *key_columns))
+            for row in inserted:
+                index, _ = pending.pop(tuple(row)[1:])
+                results[index].update(status='created', id=row.id)
+                mark_changed(*model.version_keys(row))
+            for index, _ in pending.values():
+                results[index].update(status='duplicate')
+
+    return results
+
+# Update and delete rows by id within a single transaction
+
+
+def not_applied(results, indexes):
+    '''An atomic batch with invalid records writes nothing.'''
+    for index in indexes:
+        results[index]['status'] = 'not_applied'
+    return results
+
+
+def patch_rows(model, fields, records, atomic=True):
+    '''
+    Validates patches, objects with an id and some of fields, and applies
+    them with one UPDATE per distinct set of fields, which for a batch
+    like a price refresh is a single statement. Returns a status per
+    patch in input order. An atomic batch with invalid patches writes
+    nothing. Each UPDATE runs in a savepoint, so one that breaks a unique
+    key only fails its own patches, which are marked as conflicts. An
+    atomic batch then stops and leaves the rest not applied. The caller
+    commits or rolls back.
+    '''
+    table = model.__table__
+    results = []
+    pending = {}
+    for index, record in enumerate(records):
+        results.append({'index': index})
+        try:
+            id, values = validate_patch(table, fields, record)
+        except ValueError as error:
+            results[index].update(status='invalid', error=str(error))
+            continue
+        results[index]['id'] = id
+        if id in pending:
+            results[index].update(status='invalid', error='duplicate id')
+        else:
+            pending[id] = (index, values)
+
+    reject_unknown_manufacturers(pending, results)
+    if atomic and len(pending) < len(results):
+        return not_applied(results, [index for index, _ in pending.values()])
+
+    groups = {}
+    for id, (index, values) in pending.items():
+        groups.setdefault(tuple(sorted(values)), []).append(
+            dict(values, id=id))
+
+    conflicts = False
+    for rows in groups.values():
+        if atomic and conflicts:
+            not_applied(results, [pending.pop(row['id'])[0] for row in rows])
+            continue
+        try:
+            with db.session.begin_nested():
+                updated = update_many_returning(model, rows)
+        except IntegrityError as error:
+            conflicts = True
+            for row in rows:
+                index, _ = pending.pop(row['id'])
+                results[index].update(status='conflict',
+                                      error=error.orig.diag.message_primary)
+            continue
+        for row in updated:
+            index, _ = pending.pop(row.id)
+            results[index]['status'] = 'updated'
+        for row in rows:
+            if row['id'] in pending:
+                index, _ = pending.pop(row['id'])
+                results[index].update(status='not_found')
+
+    return results
+
+
+def delete_rows(model, records, atomic=True):
+    '''
+    Deletes the rows whose ids are in records with a single DELETE, and
+    returns a status per id in input order. An atomic batch with invalid
+    ids deletes nothing. The caller commits or rolls back.
+    '''
+    results = []
+    pending = {}
+    for index, id in enumerate(records):
+        results.append({'index': index})
+        try:
+            id = validate_id(id)
+        except ValueError as error:
+            results[index].update(status='invalid', error=str(error))
+            continue
+        results[index]['id'] = id
+        if id in pending:
+            results[index].update(status='invalid', error='duplicate id')
+        else:
+            pending[id] = index
+
+    if atomic and len(pending) < len(results):
+        return not_applied(results, pending.values())
+
+    if pending:
+        for row in delete_many_returning(model, list(pending)):
+            results[pending.pop(row.id)]['status'] = 'deleted'
+    for index in pending.values():
+        results[index]['status'] = 'not_found'
+    return results
@@ -0,0 +1,275 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import current_app, request
+from metrics import registry
+from versions import conditional, resolve_keys, stamps
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# RESPONSE_CACHE is memory (default), redis or none
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'memory')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+RESPONSE_CACHE_REDIS_URL = os.environ.get('RESPONSE_CACHE_REDIS_URL',
+                                          'redis://localhost:6379/0')
+
+logger = logging.getLogger(__name__)
+
+'''
+Response cache
+
+Caches the serialized bodies of public GET responses, keyed by path and
+normalized query args. Each entry is tagged with the version keys its
+view depends on, and when a write commits and bumps those keys only the
+entries tagged with them are dropped.
+'''
+
+# In-process backend
+
+
+class MemoryBackend:
+    '''
+    Bounded LRU of response bodies. Entries expire after `ttl` seconds
+    even if no write touches them.
+    '''
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, body, _ = entry
+            if expires <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body, tags):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, body, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        with self._lock:
+            removed = 0
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    removed += 1
+            return removed
+
+    def size(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+# Redis backend, shared by every worker using the same server
+
+
+class RedisBackend:
+    '''
+    Stores bodies in Redis with a TTL, plus one set per tag listing the
+    entries tagged with it. Redis errors are logged and treated as
+    misses so the API keeps serving from Postgres.
+    '''
+
+    def __init__(self, url=RESPONSE_CACHE_REDIS_URL, ttl=RESPONSE_CACHE_TTL,
+                 prefix='pedalsdb:response:'):
+        if redis is None:
+            raise RuntimeError('RESPONSE_CACHE=redis needs the redis package')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0
+
+    def _tag_key(self, tag):
+        return self.prefix + 'tag:' + tag
+
+    def get(self, key):
+        try:
+            return self.client.get(self.prefix + key)
+        except redis.RedisError:
+            logger.warning('Response cache get failed', exc_info=True)
+            return None
+
+    def set(self, key, body, tags):
+        try:
+            pipe = self.client.pipeline()
+            pipe.set(self.prefix + key, body, ex=self.ttl)
+            for tag in tags:
+                pipe.sadd(self._tag_key(tag), self.prefix + key)
+                pipe.expire(self._tag_key(tag), self.ttl)
+            pipe.execute()
+        except redis.RedisError:
+            logger.warning('Response cache set failed', exc_info=True)
+
+    def invalidate(self, tags):
+        try:
+            pipe = self.client.pipeline()
+            for tag in tags:
+                pipe.smembers(self._tag_key(tag))
+            keys = set().union(*pipe.execute())
+            self.client.delete(*keys, *[self._tag_key(t) for t in tags])
+            return len(keys)
+        except redis.RedisError:
+            logger.warning('Response cache invalidation failed',
+                           exc_info=True)
+            return 0
+
+    def size(self):
+        return None
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(self.prefix + '*'))
+            if keys:
+                self.client.delete(*keys)
+        except redis.RedisError:
+            logger.warning('Response cache clear failed', exc_info=True)
+
+
+class ResponseCache:
+    '''Counts hits and misses in front of a backend, or of nothing.'''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls):
+        if RESPONSE_CACHE == 'redis':
+            return cls(RedisBackend())
+        if RESPONSE_CACHE == 'memory':
+            return cls(MemoryBackend())
+        return cls(None)
+
+    @staticmethod
+    def key(request):
+        args = urlencode(sorted(request.args.items(multi=True)))
+        return request.path + ('?' + args if args else '')
+
+    def get(self, key):
+        body = self.backend.get(key) if self.backend else None
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def set(self, key, body, tags):
+        if self.backend:
+            self.backend.set(key, body, tags)
+
+    def invalidate(self, tags):
+        '''Drops the entries tagged with any of tags, or all for None.'''
+        if self.backend and tags is None:
+            self.backend.clear()
+        elif self.backend:
+            self.invalidations += self.backend.invalidate(tags)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__ if self.backend else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else None,
+            'invalidations': self.invalidations,
+            'evictions': self.backend.evictions if self.backend else 0,
+            'size': self.backend.size() if self.backend else 0
+        }
+
+    def collect(self):
+        '''Metrics for the registry, see metrics.py.'''
+        stats = self.stats()
+        yield 'response_cache_hits_total', (), stats['hits']
+        yield 'response_cache_misses_total', (), stats['misses']
+        yield ('response_cache_invalidations_total', (),
+               stats['invalidations'])
+        yield 'response_cache_evictions_total', (), stats['evictions']
+        if stats['size'] is not None:
+            yield 'response_cache_entries', (), stats['size']
+
+    def clear(self):
+        if self.backend:
+            self.backend.clear()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+
+response_cache = ResponseCache.from_env()
+stamps.listeners.append(response_cache.invalidate)
+registry.register('response_cache', response_cache.collect)
+
+# Serve GET views from the response cache
+
+
+def cached(*keys):
+    '''
+    Decorates a public GET view with conditional() and the response
+    cache, keyed by path and query args and tagged with keys. A body is
+    only stored if none of its keys were bumped while it was built, so
+    a write racing the read can't leave a stale entry behind.
+    '''
+    def decorator(f):
+        @conditional(*keys)
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            tags = resolve_keys(keys, kwargs)
+            key = response_cache.key(request)
+            body = response_cache.get(key)
+            if body is not None:
+                response = current_app.response_class(
+                    body, mimetype='application/json')
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            etag, _ = stamps.validators(tags)
+            response = current_app.make_response(f(*args, **kwargs))
+            if (response.status_code == 200 and
+                    stamps.validators(tags)[0] == etag):
+                response_cache.set(key, response.get_data(), tags)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,116 @@
+import csv
+import io
+import json
+import os
+import zlib
+from flask import Response, abort, stream_with_context
+from sqlalchemy import func, select
+from models import db, Manufacturer, Pedal
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+EXPORT_MODELS = {'pedals': Pedal, 'manufacturers': Manufacturer}
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+'''
+Catalog export
+
+Streams a whole table, ordered by id, from a server-side cursor. Rows
+are fetched and encoded EXPORT_BATCH_SIZE at a time, so memory use does
+not grow with the size of the catalog.
+'''
+
+
+def export_version():
+    '''
+    Returns the oldest transaction that may still be in progress. Every
+    row written after this export started has a row_version at least
+    this high, so passing it back as since picks them all up (along with
+    a few rows the client may already have).
+    '''
+    return db.session.execute(
+        select([func.txid_snapshot_xmin(func.txid_current_snapshot())])
+    ).scalar()
+
+
+def iter_rows(model, since=None):
+    query = db.session.query(
+        *[getattr(model, field) for field in model.fields])
+    if since is not None:
+        query = query.filter(model.row_version >= since)
+    return query.order_by(model.id).yield_per(EXPORT_BATCH_SIZE)
+
+
+def batches(rows, size=EXPORT_BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Encoders, one chunk of output per batch of rows
+
+
+def encode_ndjson(model, rows):
+    for batch in batches(rows):
+        yield ''.join(
+            json.dumps(model.format_row(row), sort_keys=True,
+                       separators=(',', ':')) + '\n'
+            for row in batch).encode('utf-8')
+
+
+def encode_csv(model, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(model.fields)
+    for batch in batches(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+# Build the streamed response
+
+
+def export_response(request):
+    kind = request.args.get('type', 'pedals')
+    export_format = request.args.get('format', 'ndjson')
+    since = request.args.get('since')
+
+    if kind not in EXPORT_MODELS or export_format not in EXPORT_MIMETYPES:
+        abort(400)
+    if since is not None:
+        if not since.isdigit():
+            abort(400)
+        since = int(since)
+
+    model = EXPORT_MODELS[kind]
+    version = export_version()
+    encode = encode_ndjson if export_format == 'ndjson' else encode_csv
+    chunks = encode(model, iter_rows(model, since))
+
+    headers = {
+        'X-Catalog-Version': str(version),
+        'Vary': 'Accept-Encoding',
+        'Content-Disposition': 'attachment; filename="{}.{}"'.format(
+            kind, export_format)
+    }
+    if request.accept_encodings['gzip']:
+        chunks = gzip_chunks(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    return Response(stream_with_context(chunks), headers=headers,
+                    mimetype=EXPORT_MIMETYPES[export_format])
@@ -0,0 +1,349 @@
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Directory shared by the gunicorn workers, see Registry.gather
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10)
+# Histograms of counts rather than seconds
+HISTOGRAM_BUCKETS = {
+    'http_request_sql_statements': (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 50,
+                                    100)
+}
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DESCRIPTIONS = {
+    'http_requests_total': (
+        'counter', 'Requests by method, route and status'),
+    'http_request_duration_seconds': (
+        'histogram', 'Request latency by method and route'),
+    'http_request_sql_statements_total': (
+        'counter', 'SQL statements run by requests, by method and route'),
+    'http_request_sql_duration_seconds': (
+        'histogram', 'Time spent in SQL per request, by method and route'),
+    'http_request_sql_statements': (
+        'histogram', 'SQL statements run per request, by method and route'),
+    'query_budget_exceeded_total': (
+        'counter', 'Requests over their query budget, by method and route'),
+    'jwks_fetch_duration_seconds': (
+        'histogram', 'Time to fetch the JWKS document'),
+    'jwks_fetch_errors_total': (
+        'counter', 'Failed JWKS fetches'),
+    'jwt_verify_duration_seconds': (
+        'histogram', 'Time to verify and decode a bearer token'),
+    'token_cache_hits_total': (
+        'counter', 'Tokens served from the verified token cache'),
+    'token_cache_misses_total': (
+        'counter', 'Tokens not found in the verified token cache'),
+    'token_cache_entries': (
+        'gauge', 'Tokens in the verified token cache'),
+    'response_cache_hits_total': (
+        'counter', 'GET responses served from the response cache'),
+    'response_cache_misses_total': (
+        'counter', 'GET responses not found in the response cache'),
+    'response_cache_invalidations_total': (
+        'counter', 'Response cache entries dropped by writes'),
+    'response_cache_evictions_total': (
+        'counter', 'Response cache entries evicted to make room'),
+    'response_cache_entries': (
+        'gauge', 'Responses in the in-memory response cache'),
+    'db_pool_connections_in_use': (
+        'gauge', 'Database connections checked out'),
+    'db_pool_connections_idle': (
+        'gauge', 'Open database connections waiting in the pool'),
+    'db_pool_overflow': (
+        'gauge', 'Connections open beyond the pool size'),
+    'db_pool_waiting': (
+        'gauge', 'Callers waiting for a database connection'),
+    'db_pool_checkouts_total': (
+        'counter', 'Database connection checkouts'),
+    'db_pool_connects_total': (
+        'counter', 'New database connections opened'),
+    'db_pool_invalidations_total': (
+        'counter', 'Database connections found dead and discarded'),
+    'db_pool_timeouts_total': (
+        'counter', 'Checkouts that timed out waiting for a connection'),
+    'db_pool_checkout_wait_seconds_total': (
+        'counter', 'Time spent waiting for database connections'),
+}
+
+'''
+Metrics
+
+Request, SQL, token and pool measurements in the Prometheus text
+format, served on GET /metrics. Counters and histograms live in memory
+and cost a lock and a few additions per request. Gauges and the
+counters other modules already keep are read from collectors when the
+metrics are gathered.
+'''
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, escape(value)) for key, value in labels) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    '''
+    Holds this process's counters and histograms, keyed by name and a
+    tuple of (label, value) pairs.
+
+    With several gunicorn workers, each one only sees its own requests,
+    so with directory set every worker writes its metrics to a file
+    there at most every flush_interval seconds, and gathering sums the
+    files of all workers. Counters of workers that have exited are kept
+    so totals never go down; their gauges are dropped.
+    '''
+
+    def __init__(self, directory=METRICS_DIR,
+                 flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.counters = {}
+        self.histograms = {}
+        self.collectors = {}
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def register(self, name, collector):
+        '''
+        Adds a callable returning (name, labels, value) tuples for
+        counters and gauges kept elsewhere. Registering a name again
+        replaces its collector.
+        '''
+        self.collectors[name] = collector
+
+    def _inc(self, name, labels, value):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def _observe(self, name, labels, value):
+        key = (name, labels)
+        buckets = HISTOGRAM_BUCKETS.get(name, BUCKETS)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0]
+        histogram[0][bisect_left(buckets, value)] += 1
+        histogram[1] += value
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._inc(name, labels, value)
+
+    def observe(self, name, value, labels=()):
+        with self._lock:
+            self._observe(name, labels, value)
+
+    def record_request(self, labels, status, seconds, statements,
+                       sql_seconds):
+        with self._lock:
+            self._inc('http_requests_total',
+                      labels + (('status', status),), 1)
+            self._observe('http_request_duration_seconds', labels, seconds)
+            self._inc('http_request_sql_statements_total', labels,
+                      statements)
+            self._observe('http_request_sql_duration_seconds', labels,
+                          sql_seconds)
+
+    def snapshot(self):
+        with self._lock:
+            counters = [[name, labels, value]
+                        for (name, labels), value in self.counters.items()]
+            histograms = [[name, labels, counts[:], total]
+                          for (name, labels), (counts, total)
+                          in self.histograms.items()]
+        gauges = []
+        for collector in list(self.collectors.values()):
+            for name, labels, value in collector():
+                if DESCRIPTIONS[name][0] == 'gauge':
+                    gauges.append([name, labels, value])
+                else:
+                    counters.append([name, labels, value])
+        return {'pid': os.getpid(), 'counters': counters,
+                'histograms': histograms, 'gauges': gauges}
+
+    def path(self, pid):
+        return os.path.join(self.directory, 'metrics-{}.json'.format(pid))
+
+    def flush(self):
+        self._flushed = time.monotonic()
+        path = self.path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def maybe_flush(self):
+        if (self.directory and
+                time.monotonic() - self._flushed >= self.flush_interval):
+            self.flush()
+
+    def snapshots(self):
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory,
+                                           'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def gather(self):
+        '''Sums every worker's metrics into (counters, histograms, gauges).'''
+        counters, histograms, gauges = {}, {}, {}
+        for snapshot in self.snapshots():
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts, total in snapshot['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                summed = histograms.setdefault(key, [[0] * len(counts), 0])
+                summed[0] = [a + b for a, b in zip(summed[0], counts)]
+                summed[1] += total
+            if self.directory and not pid_running(snapshot['pid']):
+                continue
+            for name, labels, value in snapshot['gauges']:
+                labels = tuple(map(tuple, labels))
+                if self.directory:
+                    labels += (('worker', snapshot['pid']),)
+                gauges[(name, labels)] = value
+        return counters, histograms, gauges
+
+    def render(self):
+        counters, histograms, gauges = self.gather()
+        series = {}
+        for (name, labels), value in list(counters.items()) + list(
+                gauges.items()):
+            series.setdefault(name, []).append(
+                '{}{} {}'.format(name, format_labels(labels),
+                                 format_value(value)))
+        for (name, labels), (counts, total) in histograms.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            buckets = HISTOGRAM_BUCKETS.get(name, BUCKETS)
+            for bound, count in zip(buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    name, format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('{}_sum{} {}'.format(
+                name, format_labels(labels), format_value(float(total))))
+            lines.append('{}_count{} {}'.format(
+                name, format_labels(labels), cumulative))
+
+        output = []
+        for name in sorted(series):
+            kind, description = DESCRIPTIONS[name]
+            output.append('# HELP {} {}'.format(name, description))
+            output.append('# TYPE {} {}'.format(name, kind))
+            output.extend(sorted(series[name]) if kind != 'histogram'
+                          else series[name])
+        return '\n'.join(output) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+registry = Registry()
+
+
+def timed(name):
+    '''Decorates a function to observe its run time in histogram name.'''
+    def timed_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - start)
+        return wrapper
+    return timed_decorator
+
+# Per request timing, from Flask hooks and engine events
+
+
+_current = threading.local()
+
+
+def start_request():
+    _current.statements = 0
+    _current.sql_seconds = 0.0
+    _current.start = time.perf_counter()
+
+
+def finish_request(response):
+    start = getattr(_current, 'start', None)
+    if start is None:
+        return response
+    _current.start = None
+    seconds = time.perf_counter() - start
+
+    rule = request.url_rule
+    labels = (('method', request.method),
+              ('route', rule.rule if rule is not None else 'unmatched'))
+    registry.record_request(labels, response.status_code, seconds,
+                            _current.statements, _current.sql_seconds)
+    registry.maybe_flush()
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    if context is not None:
+        context.metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if getattr(_current, 'start', None) is None or context is None:
+        return
+    _current.statements += 1
+    _current.sql_seconds += time.perf_counter() - context.metrics_start
+
+
+def instrument(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+def metrics_response():
+    return current_app.response_class(registry.render(),
+                                      content_type=CONTENT_TYPE)
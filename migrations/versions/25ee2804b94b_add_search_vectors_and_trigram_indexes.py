@@ -0,0 +1,63 @@
+"""add search vectors and trigram indexes
+
+Revision ID: 25ee2804b94b
+Revises: 56108cedda84
+Create Date: 2026-10-18 17:28:00.911008
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '25ee2804b94b'
+down_revision = '56108cedda84'
+branch_labels = None
+depends_on = None
+
+
+TRIGRAM_INDEXES = [
+    ('ix_Manufacturer_name_trgm', 'Manufacturer', 'name'),
+    ('ix_Pedal_name_trgm', 'Pedal', 'name'),
+    ('ix_Pedal_pedal_type_trgm', 'Pedal', 'pedal_type'),
+]
+
+
+def upgrade():
+    op.add_column('Manufacturer', sa.Column(
+                  'search_vector', postgresql.TSVECTOR(), nullable=True))
+    op.add_column('Pedal', sa.Column(
+                  'search_vector', postgresql.TSVECTOR(), nullable=True))
+    op.execute('UPDATE "Manufacturer" SET search_vector = '
+               "to_tsvector('simple', concat_ws(' ', name))")
+    op.execute('UPDATE "Pedal" SET search_vector = '
+               "to_tsvector('simple', concat_ws(' ', name, pedal_type))")
+    op.create_index('ix_Manufacturer_search_vector', 'Manufacturer',
+                    ['search_vector'], unique=False,
+                    postgresql_using='gin')
+    op.create_index('ix_Pedal_search_vector', 'Pedal',
+                    ['search_vector'], unique=False,
+                    postgresql_using='gin')
+
+    # pg_trgm ships with Postgres' contrib modules, which some installs
+    # leave out. Search falls back to unindexed ILIKE matching without it.
+    bind = op.get_bind()
+    available = bind.execute(sa.text(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+    )).scalar()
+    if available:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, table, column in TRIGRAM_INDEXES:
+            op.create_index(name, table, [column], unique=False,
+                            postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    for name, table, column in TRIGRAM_INDEXES:
+        op.execute('DROP INDEX IF EXISTS "{}"'.format(name))
+    op.drop_index('ix_Pedal_search_vector', table_name='Pedal')
+    op.drop_index('ix_Manufacturer_search_vector', table_name='Manufacturer')
+    op.drop_column('Pedal', 'search_vector')
+    op.drop_column('Manufacturer', 'search_vector')
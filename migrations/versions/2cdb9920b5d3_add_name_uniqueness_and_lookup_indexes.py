@@ -0,0 +1,48 @@
+"""add name uniqueness and lookup indexes
+
+Revision ID: 2cdb9920b5d3
+Revises: 2f626a33639d
+Create Date: 2026-10-18 17:25:19.277187
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2cdb9920b5d3'
+down_revision = '2f626a33639d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing duplicates would block the unique constraints, so every
+    # copy after the first gets its id appended to its name. This is not
+    # undone by the downgrade.
+    op.execute(
+        'UPDATE "Manufacturer" m SET name = m.name || \' (\' || m.id || \')\' '
+        'WHERE EXISTS (SELECT 1 FROM "Manufacturer" o '
+        'WHERE o.name = m.name AND o.id < m.id)')
+    op.execute(
+        'UPDATE "Pedal" p SET name = p.name || \' (\' || p.id || \')\' '
+        'WHERE EXISTS (SELECT 1 FROM "Pedal" o '
+        'WHERE o.manufacturer_id = p.manufacturer_id '
+        'AND o.name = p.name AND o.id < p.id)')
+
+    op.create_unique_constraint('Manufacturer_name_key', 'Manufacturer',
+                                ['name'])
+    op.create_unique_constraint('Pedal_manufacturer_id_name_key', 'Pedal',
+                                ['manufacturer_id', 'name'])
+    op.create_index('ix_Pedal_manufacturer_id_id', 'Pedal',
+                    ['manufacturer_id', 'id'], unique=False)
+    op.create_index(op.f('ix_Pedal_name'), 'Pedal', ['name'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Pedal_name'), table_name='Pedal')
+    op.drop_index('ix_Pedal_manufacturer_id_id', table_name='Pedal')
+    op.drop_constraint('Pedal_manufacturer_id_name_key', 'Pedal',
+                       type_='unique')
+    op.drop_constraint('Manufacturer_name_key', 'Manufacturer',
+                       type_='unique')
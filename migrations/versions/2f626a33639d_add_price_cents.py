@@ -0,0 +1,48 @@
+"""add price cents
+
+Revision ID: 2f626a33639d
+Revises: e876d80c1564
+Create Date: 2026-10-18 17:23:48.706603
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f626a33639d'
+down_revision = 'e876d80c1564'
+branch_labels = None
+depends_on = None
+
+
+# Prices are stored as text like '$1,234.56'. Anything that does not
+# look like that is left with NULL cents.
+PRICE_PATTERN = r'^\s*\$?\s*[0-9][0-9,]*(\.[0-9]+)?\s*$'
+
+
+def backfill(column):
+    op.execute(
+        'UPDATE "Pedal" SET {0}_cents = '
+        "round(replace(replace({0}, '$', ''), ',', '')::numeric * 100) "
+        "WHERE {0} ~ '{1}'".format(column, PRICE_PATTERN))
+
+
+def upgrade():
+    op.add_column('Pedal', sa.Column(
+                  'new_price_cents', sa.Integer(), nullable=True))
+    op.add_column('Pedal', sa.Column(
+                  'used_price_cents', sa.Integer(), nullable=True))
+    backfill('new_price')
+    backfill('used_price')
+    op.create_index(op.f('ix_Pedal_new_price_cents'), 'Pedal',
+                    ['new_price_cents'], unique=False)
+    op.create_index(op.f('ix_Pedal_used_price_cents'), 'Pedal',
+                    ['used_price_cents'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Pedal_used_price_cents'), table_name='Pedal')
+    op.drop_index(op.f('ix_Pedal_new_price_cents'), table_name='Pedal')
+    op.drop_column('Pedal', 'used_price_cents')
+    op.drop_column('Pedal', 'new_price_cents')
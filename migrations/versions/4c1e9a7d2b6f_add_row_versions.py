@@ -0,0 +1,34 @@
+"""add row versions
+
+Revision ID: 4c1e9a7d2b6f
+Revises: 25ee2804b94b
+Create Date: 2026-10-18 17:52:41.208115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1e9a7d2b6f'
+down_revision = '25ee2804b94b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing rows predate every export, so they start at version 0
+    for table in ('Manufacturer', 'Pedal'):
+        op.add_column(table, sa.Column(
+                      'row_version', sa.BigInteger(), nullable=False,
+                      server_default='0'))
+        op.alter_column(table, 'row_version',
+                        server_default=sa.text('txid_current()'))
+        op.create_index('ix_{}_row_version'.format(table), table,
+                        ['row_version'], unique=False)
+
+
+def downgrade():
+    for table in ('Pedal', 'Manufacturer'):
+        op.drop_index('ix_{}_row_version'.format(table), table_name=table)
+        op.drop_column(table, 'row_version')
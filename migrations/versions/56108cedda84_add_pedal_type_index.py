@@ -0,0 +1,25 @@
+"""add pedal type index
+
+Revision ID: 56108cedda84
+Revises: 2cdb9920b5d3
+Create Date: 2026-10-18 17:26:56.388665
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '56108cedda84'
+down_revision = '2cdb9920b5d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_Pedal_pedal_type'), 'Pedal', ['pedal_type'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_Pedal_pedal_type'), table_name='Pedal')
@@ -0,0 +1,28 @@
+"""add version stamps
+
+Revision ID: 7d3f0b6a91c4
+Revises: 4c1e9a7d2b6f
+Create Date: 2026-10-18 21:14:03.527914
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d3f0b6a91c4'
+down_revision = '4c1e9a7d2b6f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('VersionStamp',
+                    sa.Column('key', sa.String(length=200), nullable=False),
+                    sa.Column('stamp', sa.String(length=64), nullable=False),
+                    sa.Column('modified', sa.BigInteger(), nullable=False),
+                    sa.PrimaryKeyConstraint('key'))
+
+
+def downgrade():
+    op.drop_table('VersionStamp')
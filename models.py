@@ -1,21 +1,293 @@
 import os
-from sqlalchemy import Column, String, Integer
+import re
+from decimal import Decimal
+from sqlalchemy import (Column, String, Integer, column, event, func,
+                        inspect, select, text, true)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert
+from sqlalchemy.orm import aliased, contains_eager, sessionmaker, validates
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 import json
+from notify import CHANGE_NOTIFY, notify_changes
+from metrics import registry
+from pool import engine_options, pool_metrics
+from replicas import RoutingSession, replicas
+from versions import manufacturer_pedals_key, stamps
 
 database_path = os.environ.get('DATABASE_URL_LIVE')
-db = SQLAlchemy()
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    '''Sends the queries of GET requests to a replica, see replicas.py.'''
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+# Matches price strings like '$1,234.56'
+PRICE_PATTERN = re.compile(r'^\s*\$?\s*([0-9][0-9,]*(?:\.[0-9]+)?)\s*$')
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", engine_options())
     db.app = app
     db.init_app(app)
+    registry.register('db_pool',
+                      lambda: pool_metrics.collect(db.engine.pool))
     migrate = Migrate(app, db)
 
 
+def price_to_cents(price):
+    '''Parse a price string like '$1,234.56' into integer cents.'''
+    match = PRICE_PATTERN.match(price) if isinstance(price, str) else None
+    if match is None:
+        return None
+    return int((Decimal(match.group(1).replace(',', '')) * 100)
+               .to_integral_value('ROUND_HALF_UP'))
+
+
+'''
+Version stamps
+
+Write paths record the version keys they touch on the session, and the
+stamps are bumped only once the transaction commits, so readers never
+see a new ETag for data that was rolled back. The same stamp is sent
+to the other workers with NOTIFY inside the transaction, and stored in
+VersionStamp, which workers load their stamps from when they start.
+'''
+
+
+class VersionStamp(db.Model):
+    '''The last stamp of each version key, shared by every worker.'''
+    __tablename__ = 'VersionStamp'
+    key = db.Column(db.String(200), primary_key=True)
+    stamp = db.Column(db.String(64), nullable=False)
+    modified = db.Column(db.BigInteger, nullable=False)
+
+
+def mark_changed(*keys):
+    db.session.info.setdefault('changed_keys', set()).update(keys)
+
+
+def store_stamp(session, keys, stamp, modified):
+    # Keys are upserted in order so that concurrent writers lock the rows
+    # in the same order
+    table = VersionStamp.__table__
+    upsert = insert(table).values([
+        {'key': key, 'stamp': stamp, 'modified': modified}
+        for key in sorted(keys)])
+    session.execute(upsert.on_conflict_do_update(
+        index_elements=['key'],
+        set_={'stamp': upsert.excluded.stamp,
+              'modified': upsert.excluded.modified})
+        .execution_options(budgeted=False))
+
+
+@event.listens_for(db.session, 'before_commit')
+def notify_changed_keys(session):
+    keys = session.info.get('changed_keys')
+    if keys:
+        session.info['changed_stamp'] = stamp = stamps.new_stamp()
+        store_stamp(session, keys, *stamp)
+        if CHANGE_NOTIFY:
+            notify_changes(session, keys, *stamp)
+
+
+@event.listens_for(db.session, 'after_commit')
+def bump_changed_keys(session):
+    keys = session.info.pop('changed_keys', None)
+    stamp = session.info.pop('changed_stamp', (None, None))
+    if keys:
+        replicas.wrote(db.engine)
+        stamps.bump(keys, *stamp)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_changed_keys(session, previous_transaction):
+    # Rolling back to a savepoint keeps the writes made before it
+    if previous_transaction.nested:
+        return
+    session.info.pop('changed_keys', None)
+    session.info.pop('changed_stamp', None)
+
+
+'''
+Single statement writes
+
+These skip the ORM and return the written row through RETURNING, so
+the caller does not need to reload it after the commit. Inserts use
+ON CONFLICT DO NOTHING on the model's unique key and return None when
+the row already exists. Patches read the row first, so they only write
+the columns that change and skip the write when nothing does.
+'''
+
+
+def returned_columns(table):
+    return [column for column in table.c
+            if column.key not in ('search_vector', 'row_version')]
+
+
+def row_version_column():
+    '''
+    Id of the transaction that last wrote the row. Inserts get it from
+    the server default and updates set it in prepare_values.
+    '''
+    return db.deferred(db.Column(
+        db.BigInteger, nullable=False, index=True,
+        server_default=db.text('txid_current()')))
+
+
+def insert_returning(model, values):
+    table = model.__table__
+    row = db.session.execute(
+        insert(table).values(**model.prepare_values(values))
+        .on_conflict_do_nothing(index_elements=model.unique_key)
+        .returning(*returned_columns(table))).first()
+    if row is not None:
+        mark_changed(*model.version_keys(row))
+    db.session.commit()
+    return row
+
+
+class VersionConflict(Exception):
+    '''The row's version doesn't match the one the writer expected.'''
+    pass
+
+
+def row_etag(row):
+    return str(row.row_version)
+
+
+def patch_returning(model, id, values, if_match=None):
+    '''
+    Sets the fields in values that differ from the row's, and returns the
+    row, with its row_version, and whether it was written. Returns
+    (None, False) if there is no such row. if_match, the request's If-Match
+    ETags, must hold the row's version or VersionConflict is raised.
+
+    The row is read without a lock and written only if its version is
+    still the one read, so a patch that changes nothing is one SELECT and
+    doesn't commit. If another transaction wrote the row in between, the
+    patch is tried again on the row read FOR UPDATE, unless the client
+    asked for the version it had seen with If-Match.
+    '''
+    table = model.__table__
+    columns = returned_columns(table) + [table.c.row_version]
+    for lock in (False, True):
+        query = select(columns).where(table.c.id == id)
+        current = db.session.execute(
+            query.with_for_update() if lock else query).first()
+        if current is None:
+            db.session.rollback()
+            return None, False
+        if if_match and not if_match.contains(row_etag(current)):
+            db.session.rollback()
+            raise VersionConflict()
+
+        changes = {field: value for field, value in values.items()
+                   if getattr(current, field) != value}
+        if not changes:
+            db.session.rollback()
+            return current, False
+
+        row = db.session.execute(
+            table.update()
+            .where(table.c.id == id)
+            .where(table.c.row_version == current.row_version)
+            .values(**model.prepare_values(changes, update=True))
+            .returning(*columns)).first()
+        if row is not None:
+            break
+        if if_match:
+            db.session.rollback()
+            raise VersionConflict()
+
+    if 'manufacturer_id' in changes:
+        # Moving a pedal also changes its previous manufacturer's pedals
+        mark_changed(*model.version_keys(current))
+    mark_changed(*model.version_keys(row))
+    db.session.commit()
+    return row, True
+
+
+def delete_returning(model, id):
+    table = model.__table__
+    row = db.session.execute(
+        table.delete().where(table.c.id == id)
+        .returning(*returned_columns(table))).first()
+    if row is not None:
+        mark_changed(*model.version_keys(row, deleted=True))
+    db.session.commit()
+    return row
+
+
+'''
+Set based writes
+
+Update or delete many rows by id with one statement, in the current
+transaction. Unlike the helpers above these don't commit, so the caller
+can roll back a batch that only partly applied.
+'''
+
+
+def unnest(table, keys, rows):
+    '''
+    rows, dicts with the same keys, as a derived table with a column per
+    key. Each column is sent as one array parameter, so the statement is
+    the same size for any number of rows.
+    '''
+    dialect = postgresql.dialect()
+    arrays = ', '.join('CAST(:{} AS {}[])'.format(
+        key, table.c[key].type.compile(dialect=dialect)) for key in keys)
+    source = text('SELECT * FROM unnest({}) AS u({})'.format(
+        arrays, ', '.join(keys)))
+    return source.bindparams(**{
+        key: [row[key] for row in rows] for key in keys
+    }).columns(*[column(key, table.c[key].type) for key in keys]) \
+        .alias('patch')
+
+
+def update_many_returning(model, rows):
+    '''
+    Applies rows, dicts with an id and the same other fields, and returns
+    the updated rows. Ids that don't exist are left out.
+    '''
+    table = model.__table__
+    ids = [row['id'] for row in rows]
+    if 'manufacturer_id' in rows[0]:
+        # Moving pedals also changes their previous manufacturers' pedals
+        for previous in db.session.execute(
+                select([table.c.manufacturer_id]).where(table.c.id.in_(ids))
+                .with_for_update()):
+            mark_changed(*model.version_keys(previous))
+
+    rows = [model.column_values(row) for row in rows]
+    patch = unnest(table, list(rows[0]), rows)
+    values = {key: patch.c[key] for key in rows[0] if key != 'id'}
+    values.update(model.computed_values(values, update=True))
+    updated = db.session.execute(
+        table.update().where(table.c.id == patch.c.id).values(**values)
+        .returning(*returned_columns(table))).fetchall()
+    for row in updated:
+        mark_changed(*model.version_keys(row))
+    return updated
+
+
+def delete_many_returning(model, ids):
+    table = model.__table__
+    deleted = db.session.execute(
+        table.delete().where(table.c.id.in_(ids))
+        .returning(*returned_columns(table))).fetchall()
+    for row in deleted:
+        mark_changed(*model.version_keys(row, deleted=True))
+    return deleted
+
+
 '''
 Manufacturer
 '''
@@ -23,25 +295,102 @@ Manufacturer
 
 class Manufacturer(db.Model):
     __tablename__ = 'Manufacturer'
+    __table_args__ = (
+        db.Index('ix_Manufacturer_search_vector', 'search_vector',
+                 postgresql_using='gin'),
+    )
+    unique_key = ('name',)
+    fields = ('id', 'name', 'website_link')
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120))
+    name = db.Column(db.String(120), unique=True)
     website_link = db.Column(db.String(500))
+    search_vector = db.deferred(db.Column(TSVECTOR))
+    row_version = row_version_column()
+    # Pedals are deleted by the foreign key's ON DELETE CASCADE
+    pedals = db.relationship('Pedal', backref='manufacturer',
+                             order_by='Pedal.id', passive_deletes=True)
+
+    @classmethod
+    def format_row(cls, row):
+        return {field: getattr(row, field) for field in cls.fields}
 
     def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'website_link': self.website_link
-        }
+        return self.format_row(self)
+
+    @classmethod
+    def with_pedal_page(cls, id, limit, offset=0, after_id=None):
+        '''
+        Loads the manufacturer with one page of its pedals, ordered by id,
+        in pedals, and returns it with its total number of pedals. The
+        manufacturer, the count and the page come from a single query
+        that only looks at pedals once the manufacturer row is found.
+        Returns (None, 0) if there is no such manufacturer.
+        '''
+        page = Pedal.query.filter(Pedal.manufacturer_id == cls.id)
+        if after_id is not None:
+            page = page.filter(Pedal.id > after_id)
+        page = page.order_by(Pedal.id).limit(limit).offset(offset) \
+            .subquery().lateral()
+        pedal = aliased(Pedal, page)
+        num_pedals = select([func.count(Pedal.id)]).where(
+            Pedal.manufacturer_id == cls.id).label('num_pedals')
+
+        rows = db.session.query(cls, num_pedals) \
+            .outerjoin(pedal, true()) \
+            .options(contains_eager(cls.pedals, alias=pedal)) \
+            .filter(cls.id == id).order_by(pedal.id) \
+            .populate_existing().all()
+        return rows[0] if rows else (None, 0)
+
+    @staticmethod
+    def version_keys(row, deleted=False):
+        '''Deleting a manufacturer cascades to its pedals.'''
+        keys = ('manufacturers', manufacturer_pedals_key(row.id))
+        return keys + ('pedals',) if deleted else keys
+
+    @staticmethod
+    def search_document(name):
+        return func.to_tsvector('simple', func.concat_ws(' ', name))
+
+    @classmethod
+    def column_values(cls, values):
+        return dict(values)
+
+    @classmethod
+    def computed_values(cls, values, update=False):
+        '''
+        The search vector when values change the name, and the row
+        version for updates. values may hold SQL expressions.
+        '''
+        computed = {}
+        if not update or 'name' in values:
+            computed['search_vector'] = cls.search_document(
+                values.get('name'))
+        if update:
+            computed['row_version'] = func.txid_current()
+        return computed
+
+    @classmethod
+    def prepare_values(cls, values, update=False):
+        values = cls.column_values(values)
+        values.update(cls.computed_values(values, update))
+        return values
 
     def insert(self):
+        self.search_vector = self.search_document(self.name)
         db.session.add(self)
+        db.session.flush()
+        mark_changed(*self.version_keys(self))
         db.session.commit()
 
     def update(self):
+        self.search_vector = self.search_document(self.name)
+        self.row_version = func.txid_current()
+        mark_changed(*self.version_keys(self))
         db.session.commit()
 
     def delete(self):
+        mark_changed(*self.version_keys(self, deleted=True))
         db.session.delete(self)
         db.session.commit()
 
@@ -53,33 +402,96 @@ Pedal
 
 class Pedal(db.Model):
     __tablename__ = 'Pedal'
+    __table_args__ = (
+        db.UniqueConstraint('manufacturer_id', 'name'),
+        db.Index('ix_Pedal_manufacturer_id_id', 'manufacturer_id', 'id'),
+        db.Index('ix_Pedal_search_vector', 'search_vector',
+                 postgresql_using='gin')
+    )
+    unique_key = ('manufacturer_id', 'name')
+    fields = ('id', 'name', 'pedal_type', 'new_price', 'used_price',
+              'manufacturer_id')
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(120))
-    pedal_type = db.Column(db.String(120))
+    name = db.Column(db.String(120), index=True)
+    pedal_type = db.Column(db.String(120), index=True)
     new_price = db.Column(db.String)
     used_price = db.Column(db.String)
+    new_price_cents = db.Column(db.Integer, index=True)
+    used_price_cents = db.Column(db.Integer, index=True)
     manufacturer_id = db.Column(db.Integer,
                                 db.ForeignKey('Manufacturer.id',
                                               ondelete='CASCADE'),
                                 nullable=False)
+    search_vector = db.deferred(db.Column(TSVECTOR))
+    row_version = row_version_column()
+
+    @classmethod
+    def format_row(cls, row):
+        return {field: getattr(row, field) for field in cls.fields}
 
     def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'pedal_type': self.pedal_type,
-            'new_price': self.new_price,
-            'used_price': self.used_price,
-            'manufacturer_id': self.manufacturer_id
-        }
+        return self.format_row(self)
+
+    @staticmethod
+    def version_keys(row, deleted=False):
+        return ('pedals', manufacturer_pedals_key(row.manufacturer_id))
+
+    @staticmethod
+    def search_document(name, pedal_type):
+        return func.to_tsvector('simple',
+                                func.concat_ws(' ', name, pedal_type))
+
+    @classmethod
+    def column_values(cls, values):
+        '''Adds the cents columns for any price strings in values.'''
+        values = dict(values)
+        for price in ('new_price', 'used_price'):
+            if price in values:
+                values[price + '_cents'] = price_to_cents(values[price])
+        return values
+
+    @classmethod
+    def computed_values(cls, values, update=False):
+        '''
+        The search vector when values change the name or type, and the
+        row version for updates. Updates fill in the other field from the
+        row being updated. values may hold SQL expressions.
+        '''
+        computed = {}
+        if not update or 'name' in values or 'pedal_type' in values:
+            computed['search_vector'] = cls.search_document(
+                values.get('name', cls.name if update else None),
+                values.get('pedal_type', cls.pedal_type if update else None))
+        if update:
+            computed['row_version'] = func.txid_current()
+        return computed
+
+    @classmethod
+    def prepare_values(cls, values, update=False):
+        values = cls.column_values(values)
+        values.update(cls.computed_values(values, update))
+        return values
+
+    @validates('new_price', 'used_price')
+    def validate_price(self, key, price):
+        setattr(self, key + '_cents', price_to_cents(price))
+        return price
 
     def insert(self):
+        self.search_vector = self.search_document(self.name, self.pedal_type)
         db.session.add(self)
+        mark_changed(*self.version_keys(self))
         db.session.commit()
 
     def update(self):
+        self.search_vector = self.search_document(self.name, self.pedal_type)
+        self.row_version = func.txid_current()
+        moved_from = inspect(self).attrs.manufacturer_id.history.deleted
+        mark_changed(*self.version_keys(self),
+                     *[manufacturer_pedals_key(id) for id in moved_from])
         db.session.commit()
 
     def delete(self):
+        mark_changed(*self.version_keys(self))
         db.session.delete(self)
         db.session.commit()
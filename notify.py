@@ -0,0 +1,174 @@
+import json
+import logging
+import os
+import select
+import threading
+from sqlalchemy import func
+from replicas import primary_lsn, replicas
+from versions import DEFAULT_STAMP_KEY, stamps
+
+# CHANGE_NOTIFY=off turns off both sending and listening
+CHANGE_NOTIFY = os.environ.get('CHANGE_NOTIFY', 'on') != 'off'
+CHANGE_CHANNEL = os.environ.get('CHANGE_CHANNEL', 'pedalsdb_changes')
+CHANGE_LISTEN_RETRY = float(os.environ.get('CHANGE_LISTEN_RETRY', 1))
+# NOTIFY payloads must stay under 8000 bytes
+KEYS_PER_NOTIFY = 100
+
+logger = logging.getLogger(__name__)
+
+'''
+Cross-worker invalidation
+
+Every gunicorn worker keeps its own version stamps and response cache,
+so a commit also NOTIFYs the keys it changed. Postgres delivers the
+notification only if the transaction commits, and every worker's
+listener thread applies the same stamps to its own copy. Each commit
+also stores its stamps in VersionStamp (see models.py), which a worker
+loads once it is listening, so that it starts with the same stamps as
+the workers already running.
+'''
+
+
+def notify_changes(session, keys, stamp, modified):
+    keys = sorted(keys)
+    for start in range(0, len(keys), KEYS_PER_NOTIFY):
+        payload = json.dumps({
+            'origin': stamps.boot,
+            'keys': keys[start:start + KEYS_PER_NOTIFY],
+            'stamp': stamp,
+            'modified': modified
+        }, separators=(',', ':'))
+        # One per KEYS_PER_NOTIFY keys, which isn't the route's own work
+        session.execute(func.pg_notify(CHANGE_CHANNEL, payload).select()
+                        .execution_options(budgeted=False))
+
+
+def load_stamps(cursor):
+    '''
+    Loads the stored stamps, after storing this worker's boot stamp as
+    the default for keys never written if no worker has yet.
+    '''
+    cursor.execute(
+        'INSERT INTO "VersionStamp" (key, stamp, modified) '
+        'VALUES (%s, %s, %s) ON CONFLICT (key) DO NOTHING',
+        (DEFAULT_STAMP_KEY, stamps.boot, stamps.boot_time))
+    cursor.execute('SELECT key, stamp, modified FROM "VersionStamp"')
+    stamps.load(cursor.fetchall())
+
+# Listen for changes committed by other workers
+
+
+class ChangeListener:
+    '''
+    Holds one dedicated connection with LISTEN on the changes channel
+    and bumps the local stamps for every notification from another
+    worker, which also evicts the matching cache entries. The stored
+    stamps are loaded once it is listening, and again after it
+    reconnects, since notifications may have been missed in between.
+    '''
+
+    def __init__(self, engine, channel=CHANGE_CHANNEL,
+                 retry_interval=CHANGE_LISTEN_RETRY, poll_interval=5):
+        self.engine = engine
+        self.channel = channel
+        self.retry_interval = retry_interval
+        self.poll_interval = poll_interval
+        self.received = 0
+        self._thread = None
+        self._stopped = threading.Event()
+        self._listening = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self.run, daemon=True,
+                                        name='change-listener')
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def wait_until_listening(self, timeout=None):
+        return self._listening.wait(timeout)
+
+    def handle(self, payload):
+        try:
+            change = json.loads(payload)
+            origin, keys = change['origin'], change['keys']
+            stamp, modified = change['stamp'], change['modified']
+        except (KeyError, TypeError, ValueError):
+            logger.warning('Ignoring malformed change notification %r',
+                           payload)
+            return
+        if origin != stamps.boot:
+            self.received += 1
+        # This worker's own changes are already applied, unless loading
+        # the stored stamps raced the write and put an older one back
+        keys = [key for key in keys if stamps.get(key) != (stamp, modified)]
+        if keys:
+            stamps.bump(keys, stamp, modified)
+
+    def listen(self, connection):
+        # The pool's pre-ping may have left a transaction open
+        connection.rollback()
+        connection.autocommit = True
+        with connection.cursor() as cursor:
+            cursor.execute('LISTEN "{}"'.format(self.channel))
+            # Writes committed from here on are notified as well
+            load_stamps(cursor)
+        self._listening.set()
+
+        while not self._stopped.is_set():
+            if select.select([connection], [], [],
+                             self.poll_interval) == ([], [], []):
+                continue
+            connection.poll()
+            while connection.notifies:
+                notifies = list(connection.notifies)
+                del connection.notifies[:]
+                # Keep reads off replicas that lag behind these writes
+                if replicas.enabled:
+                    replicas.require(primary_lsn(connection))
+                for notify in notifies:
+                    self.handle(notify.payload)
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                connection = self.engine.raw_connection()
+                connection.detach()
+                try:
+                    self.listen(connection.connection)
+                finally:
+                    self._listening.clear()
+                    connection.close()
+            except Exception:
+                logger.warning('Change listener lost its connection, '
+                               'retrying', exc_info=True)
+            self._stopped.wait(self.retry_interval)
+
+
+change_listener = None
+
+
+def start_change_listener(engine):
+    '''
+    Starts this process's listener, once, and waits for it to load the
+    stored stamps for up to CHANGE_LISTEN_RETRY seconds. Without a
+    listener, the stored stamps are loaded here instead.
+    '''
+    global change_listener
+    if CHANGE_NOTIFY and change_listener is None:
+        change_listener = ChangeListener(engine)
+        change_listener.start()
+        # So that the first request already has the stored stamps
+        change_listener.wait_until_listening(CHANGE_LISTEN_RETRY)
+    elif not CHANGE_NOTIFY:
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                load_stamps(cursor)
+            connection.commit()
+        finally:
+            connection.close()
+    return change_listener
@@ -0,0 +1,254 @@
+import base64
+import binascii
+import bisect
+import json
+import operator
+import os
+from flask import abort
+from sqlalchemy import and_, or_, text, tuple_
+from models import db
+from tracing import phase
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+COUNT_ESTIMATE_THRESHOLD = int(
+    os.environ.get('COUNT_ESTIMATE_THRESHOLD', 100000))
+
+# Count rows for a query
+
+
+def count_rows(query, model=None):
+    '''
+    Counts the rows matched by query. For an unfiltered query over a
+    whole table pass the model, so large tables can use the planner's
+    row estimate instead of a full count.
+    '''
+    if model is not None:
+        estimate = db.session.execute(
+            text('SELECT reltuples::bigint FROM pg_class '
+                 'WHERE oid = CAST(:table AS regclass)'),
+            {'table': '"{}"'.format(model.__tablename__)}).scalar()
+        if estimate is not None and estimate >= COUNT_ESTIMATE_THRESHOLD:
+            return estimate
+
+    return query.order_by(None).count()
+
+# Page through a query with LIMIT/OFFSET
+
+
+def page_limits(request):
+    '''
+    Returns the LIMIT and OFFSET of the requested page, for queries that
+    fetch the total alongside the page and check it with page_bounds.
+    '''
+    pg = request.args.get('page', 1, type=int)
+    if pg < 1:
+        abort(404)
+    return PAGE_SIZE, PAGE_SIZE * (pg - 1)
+
+
+def page_bounds(request, total):
+    '''Returns the start and stop row of the requested page.'''
+    pg = request.args.get('page', 1, type=int)
+
+    if total == 0 or pg < 1:
+        abort(404)
+
+    if pg > (total/PAGE_SIZE + 1):
+        abort(404)
+
+    start = PAGE_SIZE * (pg - 1)
+    return start, min(start + PAGE_SIZE, total)
+
+
+def format_objects(objects):
+    return [o.format() for o in objects]
+
+
+def paginate(query, request, model=None, format_page=format_objects):
+    '''
+    Returns the formatted rows for the requested page and the total
+    number of rows. Only the rows on the page are loaded. query may also
+    be a RowRange. format_page turns the list of rows into the page.
+    '''
+    if isinstance(query, RowRange):
+        return query.paginate(request)
+
+    total = count_rows(query, model)
+    start, stop = page_bounds(request, total)
+
+    objects = query.limit(stop - start).offset(start).all()
+    with phase('format'):
+        current_page = format_page(objects)
+
+    return current_page, total
+
+# Opaque cursors for keyset pagination
+
+
+def encode_cursor(sort, values):
+    raw = json.dumps({'s': sort, 'v': values}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if data['s'] != sort or not isinstance(data['v'], list):
+            raise ValueError(cursor)
+        return data['v']
+    except (binascii.Error, KeyError, TypeError, ValueError):
+        abort(400)
+
+
+def uses_cursor(request):
+    return 'cursor' in request.args or 'limit' in request.args
+
+
+def order_by_key(columns, descending=False):
+    return [column.desc() if descending else column.asc()
+            for column in columns]
+
+
+def after_key(columns, values, descending=False):
+    '''
+    Filter for rows that sort after values in the order given by
+    order_by_key. Only the first column may be nullable, and NULLs sort
+    last ascending and first descending, which is Postgres' default and
+    matches a plain btree index scanned in either direction.
+    '''
+    compare = operator.lt if descending else operator.gt
+    first, rest = columns[0], columns[1:]
+
+    if values[0] is None:
+        after = first.is_(None)
+        if len(rest) == 1:
+            after = and_(after, compare(rest[0], values[1]))
+        elif rest:
+            after = and_(after, compare(tuple_(*rest), tuple_(*values[1:])))
+        if descending:
+            after = or_(after, first.isnot(None))
+        return after
+
+    if rest:
+        after = compare(tuple_(*columns), tuple_(*values))
+    else:
+        after = compare(first, values[0])
+    if first.nullable and not descending:
+        after = or_(after, first.is_(None))
+    return after
+
+# Page through a query with keyset (cursor) pagination
+
+
+def cursor_args(request, columns, descending=False):
+    '''
+    Returns the page size, the sort string the cursors carry, and the
+    sort key values from the cursor query parameter, or None for the
+    first page.
+    '''
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    sort = ('-' if descending else '') + ','.join(
+        column.key for column in columns)
+    cursor = request.args.get('cursor')
+    if not cursor:
+        return limit, sort, None
+
+    values = decode_cursor(cursor, sort)
+    if len(values) != len(columns):
+        abort(400)
+    for column, value in zip(columns, values):
+        if value is None and column is columns[0] and column.nullable:
+            continue
+        if not isinstance(value, column.type.python_type):
+            abort(400)
+    return limit, sort, values
+
+
+def paginate_keyset(query, request, columns, descending=False,
+                    format_page=format_objects):
+    '''
+    Returns the formatted rows after the position in the cursor query
+    parameter and the cursor for the next page, or None on the last
+    page. columns are the sort key, and the last one must be unique, so
+    each page is an index range scan however deep the client pages.
+    '''
+    if isinstance(query, RowRange):
+        return query.paginate_keyset(request, columns, descending)
+
+    limit, sort, values = cursor_args(request, columns, descending)
+    if values is not None:
+        query = query.filter(after_key(columns, values, descending))
+
+    objects = query.order_by(None).order_by(
+        *order_by_key(columns, descending)).limit(limit + 1).all()
+
+    return keyset_page(objects, limit, sort, columns, format_page)
+
+
+def keyset_page(objects, limit, sort, columns, format_page=format_objects):
+    '''
+    Formats a page fetched as up to limit + 1 rows in sort order and
+    makes the cursor for the next page from the last row kept.
+    '''
+    if len(objects) == 0:
+        abort(404)
+
+    next_cursor = None
+    if len(objects) > limit:
+        objects = objects[:limit]
+        next_cursor = encode_cursor(
+            sort, [getattr(objects[-1], column.key) for column in columns])
+
+    with phase('format'):
+        current_page = format_page(objects)
+
+    return current_page, next_cursor
+
+# Page through rows held in memory
+
+
+class RowRange:
+    '''
+    Rows lo to hi of an in-memory table whose ids ascend over that range.
+    format_rows(start, stop) returns the formatted rows in that slice.
+    Pages exactly like paginate and paginate_keyset do over the same
+    rows ordered by id.
+    '''
+
+    def __init__(self, ids, lo, hi, format_rows):
+        self.ids = ids
+        self.lo = lo
+        self.hi = hi
+        self.format_rows = format_rows
+
+    def paginate(self, request):
+        total = self.hi - self.lo
+        start, stop = page_bounds(request, total)
+        with phase('format'):
+            current_page = self.format_rows(self.lo + start, self.lo + stop)
+        return current_page, total
+
+    def paginate_keyset(self, request, columns, descending=False):
+        if [column.key for column in columns] != ['id'] or descending:
+            raise ValueError('RowRange only pages by ascending id')
+
+        limit, sort, values = cursor_args(request, columns)
+        start = self.lo
+        if values is not None:
+            start = bisect.bisect_right(self.ids, values[0], self.lo, self.hi)
+        stop = min(start + limit, self.hi)
+        if start == stop:
+            abort(404)
+
+        next_cursor = None
+        if stop < self.hi:
+            next_cursor = encode_cursor(sort, [self.ids[stop - 1]])
+
+        with phase('format'):
+            current_page = self.format_rows(start, stop)
+        return current_page, next_cursor
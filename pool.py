@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+# DB_POOL is queue (default) or null, for PgBouncer in transaction mode
+DB_POOL = os.environ.get('DB_POOL', 'queue')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'on') != 'off'
+
+'''
+Connection pool
+
+Each worker process holds one pool. With the queue profile it keeps up
+to DB_POOL_SIZE connections open and opens up to DB_MAX_OVERFLOW more
+under load; a request waits up to DB_POOL_TIMEOUT seconds for one before
+failing. Connections are pinged before use and replaced after
+DB_POOL_RECYCLE seconds, so a failover costs a reconnect rather than an
+error. The null profile opens a connection per checkout and leaves the
+pooling to PgBouncer.
+'''
+
+
+class PoolMetrics:
+    '''
+    Counts checkouts and how long they waited, and tracks how many
+    connections are in use or being waited for, across the process.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.in_use = 0
+            self.waiting = 0
+            self.checkouts = 0
+            self.connects = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def wait_started(self):
+        with self._lock:
+            self.waiting += 1
+
+    def wait_ended(self, seconds, timed_out=False):
+        with self._lock:
+            self.waiting -= 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def checked_out(self, *args):
+        with self._lock:
+            self.in_use += 1
+            self.checkouts += 1
+
+    def checked_in(self, *args):
+        with self._lock:
+            self.in_use -= 1
+
+    def connected(self, *args):
+        with self._lock:
+            self.connects += 1
+
+    def invalidated(self, *args):
+        with self._lock:
+            self.invalidations += 1
+
+    def stats(self, pool=None):
+        stats = {
+            'in_use': self.in_use,
+            'waiting': self.waiting,
+            'checkouts': self.checkouts,
+            'connects': self.connects,
+            'invalidations': self.invalidations,
+            'timeouts': self.timeouts,
+            'wait_seconds_total': self.wait_seconds_total,
+            'wait_seconds_max': self.wait_seconds_max
+        }
+        if isinstance(pool, QueuePool):
+            stats.update({
+                'size': pool.size(),
+                'idle': pool.checkedin(),
+                'overflow': max(pool.overflow(), 0),
+                'max_overflow': pool._max_overflow
+            })
+        return stats
+
+    def collect(self, pool=None):
+        '''Metrics for the registry, see metrics.py.'''
+        stats = self.stats(pool)
+        yield 'db_pool_connections_in_use', (), stats['in_use']
+        yield 'db_pool_waiting', (), stats['waiting']
+        yield 'db_pool_checkouts_total', (), stats['checkouts']
+        yield 'db_pool_connects_total', (), stats['connects']
+        yield 'db_pool_invalidations_total', (), stats['invalidations']
+        yield 'db_pool_timeouts_total', (), stats['timeouts']
+        yield ('db_pool_checkout_wait_seconds_total', (),
+               stats['wait_seconds_total'])
+        if 'idle' in stats:
+            yield 'db_pool_connections_idle', (), stats['idle']
+            yield 'db_pool_overflow', (), stats['overflow']
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedCheckout:
+    '''Times how long each checkout waits for a connection.'''
+
+    def _do_get(self):
+        pool_metrics.wait_started()
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_metrics.wait_ended(time.perf_counter() - start, timed_out)
+
+
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+
+class TimedNullPool(TimedCheckout, NullPool):
+    pass
+
+
+for pool_class in (TimedQueuePool, TimedNullPool):
+    event.listen(pool_class, 'checkout', pool_metrics.checked_out)
+    event.listen(pool_class, 'checkin', pool_metrics.checked_in)
+    # Detached connections, like the change listener's, never check in
+    event.listen(pool_class, 'detach', pool_metrics.checked_in)
+    event.listen(pool_class, 'connect', pool_metrics.connected)
+    event.listen(pool_class, 'invalidate', pool_metrics.invalidated)
+
+
+def engine_options(profile=DB_POOL):
+    '''Returns the create_engine() options for a pool profile.'''
+    if profile == 'null':
+        return {'poolclass': TimedNullPool}
+    if profile != 'queue':
+        raise ValueError('Unknown DB_POOL profile {!r}'.format(profile))
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
@@ -0,0 +1,200 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, exc, text
+from pool import engine_options
+
+# Comma separated URLs of streaming replicas of DATABASE_URL_LIVE
+DATABASE_REPLICA_URLS = [
+    url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '')
+    .split(',') if url.strip()]
+REPLICA_EJECT_SECONDS = float(os.environ.get('REPLICA_EJECT_SECONDS', 30))
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 1))
+REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 30))
+REPLICA_COOKIE = 'pedalsdb_lsn'
+READ_METHODS = ('GET', 'HEAD')
+
+# WAL positions as integers. A primary has no replay position, so one
+# listed as a replica reports its current position instead. Neither
+# counts against a request's query budget
+PRIMARY_LSN_QUERY = text(
+    "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')::bigint"
+).execution_options(budgeted=False)
+REPLAY_LSN_QUERY = text(
+    "SELECT pg_wal_lsn_diff(COALESCE(pg_last_wal_replay_lsn(), "
+    "pg_current_wal_lsn()), '0/0')::bigint"
+).execution_options(budgeted=False)
+
+logger = logging.getLogger(__name__)
+
+'''
+Read replicas
+
+The queries of GET requests go to a replica, chosen round robin, and
+everything else goes to the primary. A replica is only used once it has
+replayed the WAL up to the latest write this worker knows of: its own
+commits, and other workers' commits as their NOTIFY arrives. The
+position is raised before the version stamps are bumped, so a response
+is never cached under a new ETag with data from before the write. A
+client that wrote also gets a short-lived cookie with the position of
+its write, which covers the moment before the NOTIFY reaches the worker
+serving its next read. Replicas that fail to connect are ejected for a
+while and reads fall back to the primary.
+'''
+
+
+def primary_lsn(connection):
+    '''Current WAL position of the primary, over a DBAPI connection.'''
+    with connection.cursor() as cursor:
+        cursor.execute(str(PRIMARY_LSN_QUERY))
+        return cursor.fetchone()[0]
+
+
+class Replica:
+    '''One replica engine, with its last seen replay position.'''
+
+    def __init__(self, url, engine=None):
+        self.url = url
+        self.engine = engine or create_engine(url, **engine_options())
+        self.replay_lsn = 0
+        self.checked = None
+        self.ejected_until = 0
+        event.listen(self.engine, 'handle_error', self.handle_error)
+
+    def healthy(self, now):
+        return now >= self.ejected_until
+
+    def eject(self):
+        logger.warning('Ejecting replica %s for %s seconds',
+                       self.engine.url, REPLICA_EJECT_SECONDS)
+        self.ejected_until = time.monotonic() + REPLICA_EJECT_SECONDS
+
+    def handle_error(self, context):
+        # Failed connects and dropped connections, not query errors
+        if context.connection is None or context.is_disconnect:
+            self.eject()
+
+    def probe(self, now):
+        try:
+            with self.engine.connect() as connection:
+                self.replay_lsn = connection.scalar(REPLAY_LSN_QUERY)
+        except exc.SQLAlchemyError:
+            logger.warning('Replica %s is unavailable', self.engine.url,
+                           exc_info=True)
+            self.eject()
+        self.checked = now
+
+    def caught_up(self, lsn, now):
+        '''
+        Whether the replica has replayed up to lsn. The replay position
+        is rechecked when it is too old to tell, or at most every
+        REPLICA_CHECK_INTERVAL seconds to notice a replica going down.
+        '''
+        if (self.checked is None or self.replay_lsn < lsn or
+                now - self.checked >= REPLICA_CHECK_INTERVAL):
+            self.probe(now)
+        return self.healthy(now) and self.replay_lsn >= lsn
+
+
+class ReplicaSet:
+    '''Routes the reads of GET requests to the replicas.'''
+
+    def __init__(self, urls=DATABASE_REPLICA_URLS):
+        self.replicas = [Replica(url) for url in urls]
+        self.required_lsn = 0
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.replicas)
+
+    def require(self, lsn):
+        '''Stops reads from replicas that have not replayed up to lsn.'''
+        with self._lock:
+            self.required_lsn = max(self.required_lsn, lsn)
+
+    def wrote(self, engine):
+        '''Called after a write commits on the primary engine.'''
+        if not self.enabled:
+            return
+        lsn = engine.scalar(PRIMARY_LSN_QUERY)
+        self.require(lsn)
+        if has_request_context():
+            g.written_lsn = lsn
+
+    def choose(self, lsn):
+        '''Returns the next healthy replica caught up to lsn, or None.'''
+        now = time.monotonic()
+        start = next(self._next)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if replica.healthy(now) and replica.caught_up(lsn, now):
+                return replica
+        return None
+
+    def client_lsn(self):
+        value = request.cookies.get(REPLICA_COOKIE, '')
+        return int(value) if value.isdigit() else 0
+
+    def read_engine(self):
+        '''
+        The engine for this request's queries, or None for the primary.
+        A GET request picks its replica on its first query.
+        '''
+        if (not self.enabled or not has_request_context() or
+                request.method not in READ_METHODS):
+            return None
+        if 'read_engine' not in g:
+            replica = self.choose(max(self.required_lsn, self.client_lsn()))
+            g.read_engine = replica.engine if replica else None
+        return g.read_engine
+
+    def set_cookie(self, response):
+        '''Lets the client that wrote read its write from any worker.'''
+        lsn = g.get('written_lsn')
+        if lsn is not None:
+            response.set_cookie(REPLICA_COOKIE, str(lsn),
+                                max_age=REPLICA_STICKY_SECONDS,
+                                httponly=True)
+        return response
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
+
+
+replicas = ReplicaSet()
+
+
+@contextmanager
+def on_primary():
+    '''Runs the queries in the block on the primary.'''
+    if not has_request_context():
+        yield
+        return
+    chosen = 'read_engine' in g
+    previous = g.get('read_engine')
+    g.read_engine = None
+    try:
+        yield
+    finally:
+        if chosen:
+            g.read_engine = previous
+        else:
+            g.pop('read_engine')
+
+
+class RoutingSession(SignallingSession):
+    '''Session that sends the queries of GET requests to a replica.'''
+
+    def get_bind(self, mapper=None, clause=None):
+        engine = replicas.read_engine()
+        if engine is not None:
+            return engine
+        return super().get_bind(mapper, clause)
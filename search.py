@@ -0,0 +1,77 @@
+import re
+from flask import abort
+from sqlalchemy import func, or_, text
+from models import db, Manufacturer, Pedal
+from serializer import encoders
+
+SEARCH_FIELDS = {
+    Manufacturer: ('name',),
+    Pedal: ('name', 'pedal_type'),
+}
+MAX_QUERY_LENGTH = 200
+
+_trigram_available = None
+
+# Check for the pg_trgm extension once per process
+
+
+def trigram_available():
+    global _trigram_available
+    if _trigram_available is None:
+        _trigram_available = db.session.execute(
+            text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            .execution_options(budgeted=False)).scalar() is not None
+    return _trigram_available
+
+# Build a prefix tsquery from free text
+
+
+def prefix_query(q):
+    '''
+    Turns free text into a tsquery matching every word as a prefix, so
+    "tube scr" matches "Tube Screamer". Returns None when q has no words.
+    '''
+    words = re.findall(r'\w+', q.lower())
+    if not words:
+        return None
+    return ' & '.join(word + ':*' for word in words)
+
+# Search a model by name (and type for pedals)
+
+
+def search(model, q):
+    '''
+    Returns a query for rows of model matching q, best match first.
+    Full-text matches come from the GIN-indexed search_vector. Substring
+    matches such as "69" in "BD-69" are found with ILIKE, which the
+    trigram indexes serve when pg_trgm is installed; pg_trgm also adds
+    typo-tolerant matches and ranks them by similarity.
+    '''
+    q = q.strip()
+    if not q or len(q) > MAX_QUERY_LENGTH:
+        abort(400)
+
+    columns = [getattr(model, field) for field in SEARCH_FIELDS[model]]
+    pattern = '%{}%'.format(
+        q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))
+    conditions = [column.ilike(pattern) for column in columns]
+    rank = None
+
+    tsquery = prefix_query(q)
+    if tsquery is not None:
+        query = func.to_tsquery('simple', tsquery)
+        conditions.append(model.search_vector.op('@@')(query))
+        rank = func.ts_rank(model.search_vector, query)
+
+    if trigram_available():
+        conditions.extend(column.op('%')(q) for column in columns)
+        similarity = func.greatest(
+            *[func.similarity(column, q) for column in columns])
+        rank = similarity if rank is None else rank + similarity
+
+    ordering = [model.id]
+    if rank is not None:
+        ordering.insert(0, rank.desc())
+
+    return encoders[model].query().filter(or_(*conditions)).order_by(
+        *ordering)
@@ -0,0 +1,130 @@
+import os
+import threading
+from collections import namedtuple
+from sqlalchemy import select
+from models import db, returned_columns, Manufacturer, Pedal
+from pagination import RowRange
+from replicas import on_primary
+from serializer import encoders
+from versions import stamps
+
+# CATALOG_SNAPSHOT=on serves catalog reads from memory
+CATALOG_SNAPSHOT = os.environ.get('CATALOG_SNAPSHOT', 'off') == 'on'
+
+'''
+Catalog snapshot
+
+An opt-in read mode where each worker holds the whole catalog in memory
+and serves the catalog GET endpoints without a database round trip.
+The snapshot is immutable. Any committed write, in this worker or
+another one, marks it stale, and the next read builds a new one and
+swaps it in with a single assignment.
+'''
+
+
+class TableSnapshot:
+    '''
+    Column-oriented copy of a table: one tuple per column, with rows in
+    the given order. Rows are only assembled when formatted.
+    '''
+
+    def __init__(self, model, order_by):
+        table = model.__table__
+        # Single row reads send the row version as their ETag
+        columns = returned_columns(table) + [table.c.row_version]
+        # Shared by every request until the next write, so the request
+        # that happens to build it isn't charged for it
+        rows = db.session.execute(
+            select(columns).order_by(*order_by)
+            .execution_options(budgeted=False)).fetchall()
+
+        self.model = model
+        self.Row = namedtuple(model.__name__ + 'Row',
+                              [column.key for column in columns])
+        self.columns = tuple(zip(*rows)) or tuple(() for _ in columns)
+        self.ids = self.column('id')
+        self.positions = {id: i for i, id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def column(self, key):
+        return self.columns[self.Row._fields.index(key)]
+
+    def row(self, i):
+        return self.Row(*[column[i] for column in self.columns])
+
+    def format_rows(self, start, stop):
+        return encoders[self.model].rows(
+            self.row(i) for i in range(start, stop))
+
+    def get(self, id):
+        i = self.positions.get(id)
+        return None if i is None else self.row(i)
+
+
+class CatalogSnapshot:
+    '''
+    Manufacturers ordered by id, and pedals ordered by manufacturer then
+    id with the range of each manufacturer's pedals indexed.
+    '''
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.manufacturers = TableSnapshot(Manufacturer, [Manufacturer.id])
+        self.pedals = TableSnapshot(Pedal, [Pedal.manufacturer_id, Pedal.id])
+
+        self.pedal_ranges = {}
+        for i, manufacturer_id in enumerate(
+                self.pedals.column('manufacturer_id')):
+            start, _ = self.pedal_ranges.get(manufacturer_id, (i, i))
+            self.pedal_ranges[manufacturer_id] = (start, i + 1)
+
+    def all_manufacturers(self):
+        return RowRange(self.manufacturers.ids, 0, len(self.manufacturers),
+                        self.manufacturers.format_rows)
+
+    def pedals_of(self, manufacturer_id):
+        start, stop = self.pedal_ranges.get(manufacturer_id, (0, 0))
+        return RowRange(self.pedals.ids, start, stop,
+                        self.pedals.format_rows)
+
+
+class SnapshotHolder:
+    '''
+    Hands out the current snapshot, rebuilding it first if a write has
+    bumped a version stamp since it was built. Only one request rebuilds
+    at a time.
+    '''
+
+    def __init__(self, enabled=CATALOG_SNAPSHOT):
+        self.enabled = enabled
+        self.generation = 0
+        self.builds = 0
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def invalidate(self, keys=None):
+        self.generation += 1
+
+    def get(self):
+        if not self.enabled:
+            return None
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.generation == self.generation:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.generation != self.generation:
+                # A replica may not have replayed the write that made
+                # the old snapshot stale yet
+                with on_primary():
+                    snapshot = CatalogSnapshot(self.generation)
+                self._snapshot = snapshot
+                self.builds += 1
+        return snapshot
+
+
+catalog = SnapshotHolder()
+stamps.listeners.append(catalog.invalidate)
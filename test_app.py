@@ -1,10 +1,31 @@
+import csv
+import gzip
+import io
 import os
+import select
 import unittest
 import json
+import tempfile
+import time
+from flask import jsonify
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc
 
 from app import create_app
-from models import Pedal, Manufacturer, setup_db
+from models import (db, Pedal, Manufacturer, VersionStamp, setup_db,
+                    price_to_cents)
+from auth import AuthError, JWKSKeyStore, TokenCache
+from budgets import QueryBudgetExceeded, query_budget
+from cache import MemoryBackend, ResponseCache, response_cache
+from metrics import (Registry, finish_request, registry,
+                     start_request)
+from notify import CHANGE_CHANNEL, KEYS_PER_NOTIFY, ChangeListener
+from replicas import REPLICA_COOKIE, Replica, replicas
+from pool import TimedNullPool, TimedQueuePool, engine_options, pool_metrics
+from serializer import encoders, json_response
+from snapshot import catalog
+from tracing import tracer
+from versions import DEFAULT_STAMP_KEY, VersionStamps, stamps
 
 
 class TestPedalsAPI(unittest.TestCase):
@@ -14,7 +35,7 @@ class TestPedalsAPI(unittest.TestCase):
 
     def setUp(self):
         '''Run before tests'''
-        self.app = create_app()
+        self.app = create_app({'TESTING': True})
         self.client = self.app.test_client
         self.database_path = os.environ.get('DATABASE_URL_TESTING')
         setup_db(self.app, self.database_path)
@@ -48,6 +69,38 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource was not found')
 
+    # Test cursor pagination walks every manufacturer once
+
+    def test_get_manufacturers_cursor(self):
+        seen = []
+        url = '/manufacturers?limit=20'
+        while url:
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['success'], True)
+            self.assertTrue(len(data['manufacturers']) <= 20)
+            seen.extend(m['id'] for m in data['manufacturers'])
+            url = None
+            if data['next_cursor']:
+                url = '/manufacturers?limit=20&cursor={}'.format(
+                    data['next_cursor'])
+
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertTrue(len(seen) > 20)
+
+    # Test 400 for a malformed cursor
+
+    def test_manufacturers_400_bad_cursor(self):
+        res = self.client().get('/manufacturers?cursor=not-a-cursor')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
     # Test successful get request to /manufacturers/5/pedals
 
     def test_get_pedals_by_manufacturer(self):
@@ -61,6 +114,729 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertTrue(data['num_pedals'])
         self.assertEqual(data['success'], True)
 
+    # Test cursor pagination on /manufacturers/5/pedals
+
+    def test_get_pedals_by_manufacturer_cursor(self):
+        res = self.client().get('/manufacturers/5/pedals?limit=5')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['pedals']), 5)
+        self.assertTrue(data['next_cursor'])
+
+        res = self.client().get('/manufacturers/5/pedals?limit=5&cursor={}'
+                                .format(data['next_cursor']))
+        next_data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(next_data['pedals'][0]['id'] >
+                        data['pedals'][-1]['id'])
+        self.assertEqual(next_data['manufacturer_id'], 5)
+
+    # Test a manufacturer's page of pedals is fetched with one query
+
+    def test_pedals_by_manufacturer_single_query(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = self.db.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().get('/manufacturers/7/pedals?page=2')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(len(statements), 1)
+
+            del statements[:]
+            res = self.client().get('/manufacturers/5000/pedals?limit=5')
+            self.assertEqual(res.status_code, 404)
+            self.assertEqual(len(statements), 1)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+
+    # Test 404 for pedals page out of bounds
+
+    def test_pedals_by_manufacturer_404_page_out_of_bounds(self):
+        res = self.client().get('/manufacturers/5/pedals?page=50')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource was not found')
+
+    # Test get request to /pedals filtered by type and price
+
+    def test_get_pedals_filtered(self):
+        res = self.client().get(
+            '/pedals?pedal_type=Overdrive&max_price=100&sort=price')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['num_pedals'])
+        self.assertTrue(len(data['pedals']))
+        for pedal in data['pedals']:
+            self.assertEqual(pedal['pedal_type'], 'Overdrive')
+            self.assertTrue(price_to_cents(pedal['new_price']) <= 10000)
+        prices = [price_to_cents(p['new_price']) for p in data['pedals']]
+        self.assertEqual(prices, sorted(prices))
+        self.assertEqual(data['success'], True)
+
+    # Test cursor pagination on /pedals sorted by descending used price
+
+    def test_get_pedals_cursor_sorted_by_price(self):
+        seen = []
+        url = '/pedals?manufacturer_id=7&sort=-price&price=used&limit=7'
+        while url:
+            res = self.client().get(url)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            seen.extend(data['pedals'])
+            url = None
+            if data['next_cursor']:
+                url = ('/pedals?manufacturer_id=7&sort=-price&price=used'
+                       '&limit=7&cursor={}'.format(data['next_cursor']))
+
+        res = self.client().get('/pedals?manufacturer_id=7')
+        self.assertEqual(len(seen), json.loads(res.data)['num_pedals'])
+        self.assertEqual(len({p['id'] for p in seen}), len(seen))
+        prices = [price_to_cents(p['used_price']) for p in seen]
+        self.assertEqual([p for p in prices if p is not None],
+                         sorted([p for p in prices if p is not None],
+                                reverse=True))
+
+    # Test 400 for an unknown sort key
+
+    def test_get_pedals_400_bad_sort(self):
+        res = self.client().get('/pedals?sort=color')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test 400 for price filters that aren't finite numbers
+
+    def test_get_pedals_400_price_not_finite(self):
+        for query in ('min_price=nan', 'max_price=inf', 'min_price=1e400'):
+            res = self.client().get('/pedals?' + query)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(data['success'], False)
+
+    # Test get request to /pedals with a list of ids
+
+    def test_get_pedals_by_ids(self):
+        res = self.client().get('/pedals?ids=3,1,2,5000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([p['id'] for p in data['pedals']], [1, 2, 3])
+        self.assertEqual(data['num_pedals'], 3)
+        self.assertEqual(data['success'], True)
+
+    # Test get request to /pedals/1
+
+    def test_get_pedal(self):
+        res = self.client().get('/pedals/1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['pedal']['id'], 1)
+        self.assertEqual(data['success'], True)
+
+    # Test 404 for pedal that does not exist
+
+    def test_get_pedal_404_not_exists(self):
+        res = self.client().get('/pedals/5000')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'resource was not found')
+
+    # Test searching pedals by word prefix and by model number
+
+    def test_search_pedals(self):
+        res = self.client().get('/search?q=screame')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['num_pedals'])
+        for pedal in data['pedals']:
+            self.assertIn('screamer', (pedal['name'] + ' ' +
+                                       pedal['pedal_type']).lower())
+
+        res = self.client().get('/search?q=BD-2')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('BD-2', [pedal['name'] for pedal in data['pedals']])
+        self.assertEqual(data['success'], True)
+
+    # Test searching manufacturers
+
+    def test_search_manufacturers(self):
+        res = self.client().get('/search?type=manufacturers&q=boss')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['manufacturers'][0]['name'], 'Boss')
+        self.assertEqual(data['success'], True)
+
+    # Test 400 for search without a query
+
+    def test_400_search_without_query(self):
+        res = self.client().get('/search?q=')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test conditional get requests to /manufacturers return 304
+
+    def test_get_manufacturers_not_modified(self):
+        res = self.client().get('/manufacturers')
+        etag = res.headers['ETag']
+        last_modified = res.headers['Last-Modified']
+
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/manufacturers',
+                                headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.headers['ETag'], etag)
+
+        res = self.client().get(
+            '/manufacturers',
+            headers={'If-Modified-Since': last_modified})
+
+        self.assertEqual(res.status_code, 304)
+
+    # Test a pedal write changes only its manufacturer's pedals ETag
+
+    def test_pedal_write_changes_etag(self):
+        boss = self.client().get('/manufacturers/7/pedals')
+        ehx = self.client().get('/manufacturers/14/pedals')
+
+        res = self.client().post(
+            '/pedals?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={
+                'name': 'ETag Chorus',
+                'pedal_type': 'Chorus',
+                'new_price': '$99.00',
+                'used_price': None,
+                'manufacturer_id': 7
+            })
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(
+            '/manufacturers/7/pedals',
+            headers={'If-None-Match': boss.headers['ETag']})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], boss.headers['ETag'])
+
+        res = self.client().get(
+            '/manufacturers/14/pedals',
+            headers={'If-None-Match': ehx.headers['ETag']})
+
+        self.assertEqual(res.status_code, 304)
+
+    # Test repeated gets are served from the response cache until a write
+
+    def test_response_cache_invalidated_by_write(self):
+        res = self.client().get('/manufacturers/12/pedals?page=1')
+        body = res.data
+
+        res = self.client().get('/manufacturers/12/pedals?page=1')
+
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(res.data, body)
+
+        res = self.client().patch(
+            '/pedals/111?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={
+                'name': 'JC95 Jerry Cantrell Cry Baby',
+                'pedal_type': 'Wah',
+                'new_price': '$170.00',
+                'used_price': '$150.00',
+                'manufacturer_id': 12
+            })
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get('/manufacturers/12/pedals?page=1')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        self.assertIn('$170.00', [p['new_price'] for p in data['pedals']])
+
+    # Test a committed write is sent to the other workers with NOTIFY
+
+    def test_write_notifies_changes(self):
+        with self.app.app_context():
+            connection = db.get_engine().raw_connection()
+        connection.connection.rollback()
+        connection.connection.autocommit = True
+        connection.cursor().execute('LISTEN "{}"'.format(CHANGE_CHANNEL))
+
+        res = self.client().post(
+            '/manufacturers?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={
+                'name': 'Notify Audio',
+                'website_link': 'https://www.notify.com'
+            })
+        manufacturer_id = json.loads(res.data)['created_manufacturer']
+
+        deadline = time.monotonic() + 5
+        while (not connection.connection.notifies and
+               time.monotonic() < deadline):
+            select.select([connection.connection], [], [], 0.1)
+            connection.connection.poll()
+        changes = [json.loads(n.payload)
+                   for n in connection.connection.notifies]
+        connection.cursor().execute('UNLISTEN *')
+        connection.connection.autocommit = False
+        connection.close()
+
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]['origin'], stamps.boot)
+        self.assertIn('manufacturers', changes[0]['keys'])
+        self.assertIn('manufacturers/{}/pedals'.format(manufacturer_id),
+                      changes[0]['keys'])
+
+    # Test /metrics reports requests, their SQL and the pool
+
+    def test_metrics(self):
+        self.client().get('/pedals/1')
+        res = self.client().get('/metrics')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('# TYPE http_request_duration_seconds histogram', lines)
+        labels = '{method="GET",route="/pedals/<int:pedal_id>"'
+        requests = [line for line in lines if line.startswith(
+            'http_requests_total' + labels + ',status="200"}')]
+        self.assertEqual(len(requests), 1)
+        self.assertGreaterEqual(int(requests[0].split()[-1]), 1)
+        self.assertIn('http_request_sql_statements_total' + labels + '}',
+                      res.data.decode())
+        self.assertTrue(any(line.startswith('db_pool_checkouts_total ')
+                            for line in lines))
+
+    # Helper for the tracing tests
+
+    def trace(self, **settings):
+        previous = dict(vars(tracer))
+        self.addCleanup(vars(tracer).update, previous)
+        vars(tracer).update(settings, enabled=True, sample=1)
+        response_cache.clear()
+
+    # Test traced requests get a Server-Timing header
+
+    def test_server_timing(self):
+        res = self.client().get('/pedals?page=2')
+        self.assertNotIn('Server-Timing', res.headers)
+
+        self.trace()
+        res = self.client().get('/pedals?page=2')
+        phases = {entry.split(';')[0]: entry for entry
+                  in res.headers['Server-Timing'].split(', ')}
+
+        self.assertEqual(set(phases),
+                         {'db', 'format', 'serialize', 'total'})
+        self.assertRegex(phases['db'], r'^db;dur=[0-9.]+;desc="3 queries"$')
+
+    # Test slow requests are logged with their SQL and plans
+
+    def test_slow_request_log(self):
+        self.trace(slow_ms=0, explain=True)
+        with self.assertLogs('pedalsdb.slow_requests', 'WARNING') as logs:
+            self.client().get('/pedals/3')
+        entry = json.loads(logs.records[0].getMessage())
+
+        self.assertEqual(entry['path'], '/pedals/3')
+        self.assertEqual(entry['status'], 200)
+        self.assertEqual(len(entry['statements']), 1)
+        statement = entry['statements'][0]
+        self.assertIn('FROM "Pedal"', statement['sql'])
+        self.assertIn(3, statement['parameters'].values())
+        self.assertTrue(any('actual time' in line
+                            for line in statement['explain']))
+
+    # Test every route declares its query budget
+
+    def test_routes_declare_query_budgets(self):
+        for rule in self.app.url_map.iter_rules():
+            if rule.endpoint == 'static':
+                continue
+            view = self.app.view_functions[rule.endpoint]
+            self.assertTrue(hasattr(view, 'query_budget'), rule.rule)
+
+    # Test a request over its query budget fails in testing
+
+    def test_query_budget_exceeded(self):
+        @self.app.route('/budget-test')
+        @query_budget(1)
+        def two_queries():
+            Pedal.query.get(1)
+            Manufacturer.query.get(1)
+            return jsonify({'success': True})
+
+        with self.assertRaisesRegex(QueryBudgetExceeded,
+                                    '2 SQL statements.*budget of 1'):
+            self.client().get('/budget-test')
+
+    # Test a statement run once per row is reported as an N+1
+
+    def test_query_budget_repeats(self):
+        @self.app.route('/budget-test')
+        @query_budget(None)
+        def n_plus_one():
+            for id in range(1, 6):
+                db.session.query(Pedal.name).filter(Pedal.id == id).all()
+            return jsonify({'success': True})
+
+        with self.assertRaisesRegex(QueryBudgetExceeded,
+                                    'same statement 5 times.*N\\+1'):
+            self.client().get('/budget-test')
+
+    # Test production only logs and counts budget overruns
+
+    def test_query_budget_reported(self):
+        self.app.testing = False
+
+        @self.app.route('/budget-test')
+        @query_budget(0)
+        def one_query():
+            Pedal.query.get(1)
+            return jsonify({'success': True})
+
+        with self.assertLogs('pedalsdb.query_budgets', 'WARNING'):
+            res = self.client().get('/budget-test')
+        output = self.client().get('/metrics').data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        labels = 'method="GET",route="/budget-test"'
+        self.assertIn('query_budget_exceeded_total{' + labels + '} ', output)
+        self.assertIn('http_request_sql_statements_bucket{' + labels +
+                      ',le="1"} ', output)
+
+    # Helpers for the read replica tests
+
+    def use_replica(self, replica):
+        replicas.replicas = [replica]
+        self.addCleanup(setattr, replicas, 'replicas', [])
+        self.addCleanup(replica.engine.dispose)
+        response_cache.clear()
+        return replica
+
+    def statements_on(self, engine):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', count)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', count)
+        return statements
+
+    def create_manufacturer(self, client, name):
+        res = client.post(
+            '/manufacturers?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={'name': name, 'website_link': 'https://www.replica.com'})
+        self.assertEqual(res.status_code, 200)
+        return res
+
+    # Test GET requests read from a replica and writes go to the primary
+
+    def test_reads_routed_to_replica(self):
+        with self.app.app_context():
+            primary = self.db.get_engine()
+        replica = self.use_replica(Replica(self.database_path))
+        on_primary = self.statements_on(primary)
+        on_replica = self.statements_on(replica.engine)
+
+        res = self.client().get('/pedals?ids=1,2')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(on_replica)
+        self.assertEqual(on_primary, [])
+
+        del on_replica[:]
+        res = self.create_manufacturer(self.client(), 'Replica Audio')
+        self.assertTrue(on_primary)
+        self.assertEqual(on_replica, [])
+        self.assertIn(REPLICA_COOKIE + '=', res.headers['Set-Cookie'])
+
+    # Test reads after a write skip a replica that has not replayed it
+
+    def test_lagging_replica_skipped_after_write(self):
+        class LaggingReplica(Replica):
+            def probe(self, now):
+                self.replay_lsn = lag
+                self.checked = now
+
+        with self.app.app_context():
+            primary = self.db.get_engine()
+        lag = replicas.required_lsn
+        replica = self.use_replica(LaggingReplica(self.database_path))
+        on_primary = self.statements_on(primary)
+        on_replica = self.statements_on(replica.engine)
+
+        self.client().get('/pedals/1')
+        self.assertTrue(on_replica)
+
+        writer = self.client()
+        self.create_manufacturer(writer, 'Lagging Audio')
+        del on_primary[:], on_replica[:]
+        self.client().get('/pedals/2')
+        self.assertTrue(on_primary)
+        self.assertEqual(on_replica, [])
+
+        # The cookie alone keeps the writer on the primary
+        written = replicas.required_lsn
+        lag = written - 1
+        replicas.required_lsn = 0
+        del on_primary[:]
+        writer.get('/pedals/3')
+        self.assertTrue(on_primary)
+        self.assertEqual(on_replica, [])
+
+        self.client().get('/pedals/4')
+        self.assertTrue(on_replica)
+        replicas.require(written)
+
+    # Test an unreachable replica is ejected and reads use the primary
+
+    def test_unreachable_replica_ejected(self):
+        replica = self.use_replica(
+            Replica('postgresql://localhost:1/pedalsdb_replica'))
+
+        res = self.client().get('/pedals/1')
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(replica.healthy(time.monotonic()))
+
+    # Test the listener applies changes committed by another worker
+
+    def test_listener_applies_notified_changes(self):
+        with self.app.app_context():
+            engine = db.get_engine()
+        listener = ChangeListener(engine, poll_interval=0.1)
+        listener.start()
+        self.assertTrue(listener.wait_until_listening(5))
+
+        payload = json.dumps({'origin': 'other', 'keys': ['pedals'],
+                              'stamp': 'other.1', 'modified': 1})
+        with engine.begin() as connection:
+            connection.execute('SELECT pg_notify(%s, %s)',
+                               CHANGE_CHANNEL, payload)
+
+        deadline = time.monotonic() + 5
+        while listener.received == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        listener.stop()
+
+        self.assertEqual(stamps.get('pedals'), ('other.1', 1))
+        self.assertEqual(listener.received, 1)
+
+    # Test workers started at different times agree on the stored stamps
+
+    def test_workers_share_stored_stamps(self):
+        first, second = VersionStamps(), VersionStamps()
+        bumped = []
+        second.listeners.append(bumped.append)
+        keys = ['manufacturers', 'pedals']
+        self.assertNotEqual(first.validators(keys),
+                            second.validators(keys))
+
+        rows = [(DEFAULT_STAMP_KEY, first.boot, first.boot_time),
+                ('pedals', 'other.7', 1700000000)]
+        first.load(rows)
+        second.load(rows)
+
+        self.assertEqual(first.validators(keys), second.validators(keys))
+        self.assertEqual(second.validators(['pedals'])[1], 1700000000)
+        self.assertEqual(bumped, [['pedals']])
+        second.load(rows)
+        self.assertEqual(bumped, [['pedals']])
+
+    # Test a committed write stores its stamp for workers started later
+
+    def test_write_stores_stamp(self):
+        res = self.client().patch(
+            '/manufacturers/42?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={'website_link': 'https://www.t-rex-effects.com/en/'})
+        self.assertEqual(res.status_code, 200)
+
+        with self.app.app_context():
+            stored = {row.key: (row.stamp, row.modified)
+                      for row in VersionStamp.query}
+        self.assertEqual(stored['manufacturers'],
+                         stamps.get('manufacturers'))
+        self.assertEqual(stored['manufacturers/42/pedals'],
+                         stamps.get('manufacturers'))
+
+    # Test catalog reads served from the snapshot match the database
+
+    def test_catalog_snapshot_matches_database(self):
+        res = self.client().get('/manufacturers/7/pedals?limit=5')
+        cursor = json.loads(res.data)['next_cursor']
+        urls = ['/manufacturers?page=2', '/manufacturers?page=500',
+                '/manufacturers?limit=7',
+                '/manufacturers/7/pedals',
+                '/manufacturers/7/pedals?limit=5&cursor=' + cursor,
+                '/manufacturers/5000/pedals', '/pedals/5', '/pedals/5000',
+                '/pedals?ids=3,1,2,5000']
+        expected = [self.client().get(url) for url in urls]
+
+        catalog.enabled = True
+        response_cache.clear()
+        try:
+            for url, res in zip(urls, expected):
+                snapshot_res = self.client().get(url)
+
+                self.assertEqual(snapshot_res.status_code, res.status_code)
+                self.assertEqual(snapshot_res.data, res.data)
+        finally:
+            catalog.enabled = False
+            response_cache.clear()
+
+    # Test a write swaps in a new snapshot
+
+    def test_catalog_snapshot_rebuilt_after_write(self):
+        catalog.enabled = True
+        try:
+            self.client().get('/pedals/6')
+            builds = catalog.builds
+
+            res = self.client().patch(
+                '/pedals/6?return=minimal',
+                headers={
+                    "Authorization": "Bearer {}".format(self.site_owner_token)
+                },
+                json={'name': 'Snapshot Drive', 'pedal_type': 'Overdrive',
+                      'new_price': '$80.00', 'used_price': None,
+                      'manufacturer_id': 4})
+            self.assertEqual(res.status_code, 200)
+
+            res = self.client().get('/pedals/6')
+            data = json.loads(res.data)
+
+            self.assertEqual(data['pedal']['name'], 'Snapshot Drive')
+            self.assertEqual(catalog.builds, builds + 1)
+        finally:
+            catalog.enabled = False
+
+    # Test streamed NDJSON export of all pedals
+
+    def test_export_ndjson(self):
+        res = self.client().get('/export?format=ndjson')
+        lines = res.data.decode('utf-8').splitlines()
+        num_pedals = json.loads(
+            self.client().get('/pedals').data)['num_pedals']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(res.headers['X-Catalog-Version'].isdigit())
+        self.assertEqual(len(lines), num_pedals)
+        self.assertEqual(json.loads(lines[0]),
+                         json.loads(self.client().get(
+                             '/pedals/{}'.format(json.loads(lines[0])['id'])
+                         ).data)['pedal'])
+
+    # Test gzipped CSV export of manufacturers
+
+    def test_export_csv_gzip(self):
+        res = self.client().get('/export?type=manufacturers&format=csv',
+                                headers={'Accept-Encoding': 'gzip'})
+        rows = list(csv.reader(io.StringIO(
+            gzip.decompress(res.data).decode('utf-8'))))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(rows[0], ['id', 'name', 'website_link'])
+        self.assertEqual(rows[1][1], 'Ampeg')
+
+    # Test export since a version only returns rows written after it
+
+    def test_export_since(self):
+        res = self.client().get('/export?type=manufacturers')
+        version = res.headers['X-Catalog-Version']
+
+        res = self.client().patch(
+            '/manufacturers/3?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={'name': 'AMT Electronics',
+                  'website_link': 'https://amtelectronics.com/'})
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().get(
+            '/export?type=manufacturers&since={}'.format(version))
+        rows = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual([row['id'] for row in rows], [3])
+
+    # Test 400 for an unknown export format
+
+    def test_export_400_bad_format(self):
+        res = self.client().get('/export?format=xml')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test the column-tuple encoder matches jsonify of format()
+
+    def test_encoder_matches_jsonify(self):
+        unusual = Pedal(id=-1, name='Fuzz "Face" \\ \u00e9\u2603',
+                        pedal_type='Fuzz\n', new_price=None,
+                        used_price='$1.00', manufacturer_id=None)
+        with self.app.test_request_context():
+            for model in (Manufacturer, Pedal):
+                encoder = encoders[model]
+                rows = encoder.query().order_by(model.id).all()
+                objects = model.query.order_by(model.id).all()
+                if model is Pedal:
+                    objects.append(unusual)
+                    rows.append(unusual)
+
+                expected = jsonify({
+                    'rows': [o.format() for o in objects],
+                    'row': objects[-1].format(),
+                    'total': len(objects),
+                    'success': True
+                }).data
+                actual = json_response({
+                    'rows': encoder.rows(rows),
+                    'row': encoder.row(rows[-1]),
+                    'total': len(rows),
+                    'success': True
+                }).data
+
+                self.assertEqual(actual, expected)
+
     # Test 404 for page out of bounds
 
     def test_404_manufacturer_not_exists(self):
@@ -134,6 +910,30 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertTrue(data['num_pedals'])
         self.assertEqual(data['success'], True)
 
+    # Test post request to /pedals with a minimal response
+
+    def test_post_pedal_minimal(self):
+        res = self.client().post(
+            '/pedals?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={
+                'name': 'Minimal Fuzz',
+                'pedal_type': 'Fuzz',
+                'new_price': '$120.00',
+                'used_price': None,
+                'manufacturer_id': 37
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['created_pedal'])
+        self.assertEqual(data['pedal']['id'], data['created_pedal'])
+        self.assertEqual(data['pedal']['name'], 'Minimal Fuzz')
+        self.assertNotIn('pedals', data)
+        self.assertEqual(data['success'], True)
+
     # Test unsuccessful post request entry already exists to /pedals
 
     def test_pedal_already_exists(self):
@@ -157,6 +957,99 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertTrue(data['num_pedals'])
         self.assertEqual(data['success'], False)
 
+    # Test bulk post request to /pedals/bulk with a JSON array
+
+    def test_bulk_post_pedals(self):
+        res = self.client().post(
+            '/pedals/bulk',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json=[
+                {'name': 'Bulk Drive', 'pedal_type': 'Overdrive',
+                 'new_price': '$99.00', 'manufacturer_id': 37},
+                {'name': 'Afterglow', 'pedal_type': 'Chorus',
+                 'manufacturer_id': 43},
+                {'name': 'Bulk Drive', 'pedal_type': 'Overdrive',
+                 'manufacturer_id': 37},
+                {'name': 'No Maker', 'pedal_type': 'Fuzz'},
+                {'name': 'Bad Maker', 'manufacturer_id': 5000}
+            ])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['created', 'duplicate', 'duplicate',
+                          'invalid', 'invalid'])
+        self.assertTrue(data['results'][0]['id'])
+        self.assertEqual(data['num_created'], 1)
+        self.assertEqual(data['num_duplicates'], 2)
+        self.assertEqual(data['num_invalid'], 2)
+        self.assertEqual(data['success'], True)
+
+    # Test bulk post request to /manufacturers/bulk with NDJSON
+
+    def test_bulk_post_manufacturers_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'name': 'Bulk Audio One'}),
+            'not json',
+            json.dumps({'name': 'Bulk Audio Two',
+                        'website_link': 'https://www.bulkaudio.com'})
+        ])
+        res = self.client().post(
+            '/manufacturers/bulk?batch_size=1',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['created', 'invalid', 'created'])
+        self.assertEqual(data['num_created'], 2)
+        self.assertEqual(data['success'], True)
+
+    # Test post request to /pedals with a name used by another manufacturer
+
+    def test_post_pedal_name_used_by_other_manufacturer(self):
+        res = self.client().post(
+            '/pedals',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={
+                'name': 'Afterglow',
+                'pedal_type': 'Chorus',
+                'new_price': '$89.00',
+                'used_price': None,
+                'manufacturer_id': 30
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['created_pedal'])
+        self.assertEqual(data['success'], True)
+
+    # Test 422 for patch request renaming to an existing manufacturer name
+
+    def test_patch_422_manufacturer_name_exists(self):
+        res = self.client().patch(
+            '/manufacturers/39',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={
+                'name': 'Boss',
+                'website_link': 'https://www.bossaudio.com'
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unprocessable entity')
+
     # Test patch request to /manufacturers/37
 
     def test_update_manufacturer(self):
@@ -217,6 +1110,48 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertTrue(data['num_pedals'])
         self.assertEqual(data['success'], True)
 
+    # Test patch request to /manufacturers/38 with Prefer: return=minimal
+
+    def test_update_manufacturer_minimal(self):
+        res = self.client().patch(
+            '/manufacturers/38',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token),
+                "Prefer": "return=minimal"
+            },
+            json={
+                'name': 'Minimal Name',
+                'website_link': 'https://www.minimal.com'
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Preference-Applied'], 'return=minimal')
+        self.assertEqual(data['updated_manufacturer'], 38)
+        self.assertEqual(data['manufacturer']['name'], 'Minimal Name')
+        self.assertNotIn('manufacturers', data)
+        self.assertEqual(data['success'], True)
+
+    # Test minimal patch request not found to /pedals/5000
+
+    def test_patch_minimal_404_pedal_not_exists(self):
+        res = self.client().patch(
+            '/pedals/5000?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={
+                'name': 'Hot Rod',
+                'pedal_type': 'Distortion',
+                'new_price': '$79.00',
+                'used_price': '$45.00',
+                'manufacturer_id': 25
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     # Test unsuccessful patch request not found to /pedals/5000
 
     def test_patch_404_pedal_not_exists(self):
@@ -238,6 +1173,165 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource was not found')
 
+    # Test patch request to /pedals/480 only sets the fields it sends
+
+    def test_partial_update_pedal(self):
+        res = self.client().patch(
+            '/pedals/480?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={'used_price': '$65.00'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.headers.get('ETag'))
+        self.assertEqual(data['pedal'], {
+            'id': 480,
+            'name': 'D7 ',
+            'pedal_type': 'Delay',
+            'new_price': '$105.00',
+            'used_price': '$65.00',
+            'manufacturer_id': 30
+        })
+        res = self.client().get('/pedals?manufacturer_id=30&price=used'
+                                '&max_price=65')
+        self.assertIn(480, [p['id'] for p in json.loads(res.data)['pedals']])
+
+    # Test patch request with the pedal's own values doesn't write
+
+    def test_noop_patch_pedal(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.site_owner_token)
+        }
+        res = self.client().patch('/pedals/481?return=minimal',
+                                  headers=headers, json={})
+        etag = res.headers['ETag']
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = self.db.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().patch(
+                '/pedals/481?return=minimal',
+                headers=headers,
+                json={'pedal_type': 'Ambience Reverb',
+                      'new_price': '$175.00'})
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['pedal']['used_price'], '$110.00')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('SELECT'))
+
+    # Test patch requests to /pedals/482 with If-Match
+
+    def test_patch_pedal_if_match(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.site_owner_token)
+        }
+        res = self.client().get('/pedals/482')
+        etag = res.headers['ETag']
+        res = self.client().get('/pedals/482',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+
+        res = self.client().patch(
+            '/pedals/482?return=minimal',
+            headers=dict(headers, **{'If-Match': etag}),
+            json={'new_price': '$95.00'})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+        res = self.client().patch(
+            '/pedals/482?return=minimal',
+            headers=dict(headers, **{'If-Match': etag}),
+            json={'new_price': '$99.00'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'precondition failed')
+        res = self.client().get('/pedals/482')
+        self.assertEqual(json.loads(res.data)['pedal']['new_price'],
+                         '$95.00')
+
+    # Test get request to /manufacturers/41 gives the ETag PATCH checks
+
+    def test_get_manufacturer_if_match(self):
+        res = self.client().get('/manufacturers/41')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['manufacturer']['name'], 'Rocktron')
+        etag = res.headers['ETag']
+
+        res = self.client().patch(
+            '/manufacturers/41?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token),
+                "If-Match": etag
+            },
+            json={'website_link': 'https://www.rocktron.com/'})
+
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/manufacturers/41',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['manufacturer']['website_link'],
+                         'https://www.rocktron.com/')
+
+    # Test get request to /manufacturers/5000 not found
+
+    def test_get_manufacturer_404(self):
+        res = self.client().get('/manufacturers/5000')
+
+        self.assertEqual(res.status_code, 404)
+
+    # Test patch request to /pedals/483 with the body from a get
+
+    def test_patch_pedal_echoed_body(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.site_owner_token)
+        }
+        pedal = json.loads(self.client().get('/pedals/483').data)['pedal']
+
+        res = self.client().patch(
+            '/pedals/483?return=minimal', headers=headers,
+            json=dict(pedal, used_price='$70.00'))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['pedal'],
+                         dict(pedal, used_price='$70.00'))
+
+        res = self.client().patch(
+            '/pedals/483?return=minimal', headers=headers,
+            json=dict(pedal, id=484))
+
+        self.assertEqual(res.status_code, 422)
+
+    # Test 422 for patch request with a field pedals don't have
+
+    def test_patch_422_pedal_unknown_field(self):
+        res = self.client().patch(
+            '/pedals/483',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json={'price': '$79.00'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'unprocessable entity')
+
     # Test delete request to /manufacturers/29
 
     def test_delete_manufacturer(self):
@@ -285,6 +1379,21 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertTrue(data['num_pedals'])
         self.assertEqual(data['success'], True)
 
+    # Test delete request to /pedals/601 with a minimal response
+
+    def test_delete_pedal_minimal(self):
+        res = self.client().delete(
+            '/pedals/601?return=minimal',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted_pedal'], 601)
+        self.assertNotIn('pedals', data)
+        self.assertEqual(data['success'], True)
+
     # Test delete manufacturer not found to /manufacturers/5000
 
     def test_404_pedal_to_delete_not_exists(self):
@@ -300,6 +1409,167 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'resource was not found')
 
+    # Test batch patch request to /pedals updates prices with one UPDATE
+
+    def test_batch_update_pedals(self):
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = self.db.get_engine()
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().patch(
+                '/pedals',
+                headers={
+                    "Authorization": "Bearer {}".format(
+                        self.site_owner_token)
+                },
+                json=[{'id': 700, 'used_price': '$65.00'},
+                      {'id': 701, 'used_price': '$1,050.00'}])
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['updated', 'updated'])
+        self.assertEqual(data['num_updated'], 2)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len([s for s in statements
+                              if s.startswith('UPDATE')]), 1)
+
+        res = self.client().get('/pedals?manufacturer_id=43&price=used'
+                                '&min_price=1000')
+        pedals = {p['id']: p for p in json.loads(res.data)['pedals']}
+        self.assertIn(701, pedals)
+        self.assertNotIn(700, pedals)
+        self.assertEqual(pedals[701]['used_price'], '$1,050.00')
+        self.assertEqual(pedals[701]['new_price'], '$58.00')
+
+    # Test a batch patch with a missing pedal applies nothing
+
+    def test_batch_update_pedals_atomic(self):
+        res = self.client().patch(
+            '/pedals',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json=[{'id': 703, 'used_price': '$1.00'},
+                  {'id': 5000, 'used_price': '$1.00'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['not_applied', 'not_found'])
+        self.assertEqual(data['num_updated'], 0)
+        self.assertEqual(data['success'], False)
+        res = self.client().get('/pedals/703')
+        self.assertEqual(json.loads(res.data)['pedal']['used_price'],
+                         '$130.00')
+
+    # Test an all or nothing batch patch reports a unique name conflict
+
+    def test_batch_update_pedals_atomic_conflict(self):
+        res = self.client().patch(
+            '/pedals',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json=[{'id': 702, 'used_price': '$1.00'},
+                  {'id': 704, 'name': 'V3 Route 66'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['not_applied', 'conflict'])
+        self.assertEqual(data['num_updated'], 0)
+        self.assertEqual(data['num_conflicts'], 1)
+        self.assertEqual(data['success'], False)
+        res = self.client().get('/pedals/702')
+        self.assertEqual(json.loads(res.data)['pedal']['used_price'],
+                         '$150.00')
+
+    # Test a batch delete that NOTIFYs more than one chunk of keys
+
+    def test_batch_delete_many_manufacturers(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.site_owner_token)
+        }
+        res = self.client().post(
+            '/manufacturers/bulk', headers=headers,
+            json=[{'name': 'Batch Maker {}'.format(i),
+                   'website_link': 'https://example.com/{}'.format(i)}
+                  for i in range(KEYS_PER_NOTIFY + 20)])
+        ids = [r['id'] for r in json.loads(res.data)['results']]
+
+        res = self.client().delete('/manufacturers', headers=headers,
+                                   json=ids)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['num_deleted'], len(ids))
+
+    # Test a batch patch with atomic=false reports each manufacturer
+
+    def test_batch_update_manufacturers_per_item(self):
+        res = self.client().patch(
+            '/manufacturers?atomic=false',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json=[{'id': 44, 'website_link': 'https://www.tech21nyc.com'},
+                  {'id': 45, 'name': 'Vox'},
+                  {'id': 'x', 'name': 'Nobody'},
+                  {'id': 46, 'founded': 2012},
+                  {'id': 5000, 'website_link': 'https://www.example.com'}])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['updated', 'conflict', 'invalid', 'invalid',
+                          'not_found'])
+        self.assertEqual(data['results'][3]['error'],
+                         'unknown field founded')
+        self.assertEqual(data['num_updated'], 1)
+        self.assertEqual(data['num_conflicts'], 1)
+        self.assertEqual(data['success'], True)
+
+        res = self.client().get('/manufacturers/45/pedals')
+        self.assertEqual(json.loads(res.data)['manufacturer_name'],
+                         'Truetone')
+
+    # Test batch delete request to /pedals
+
+    def test_batch_delete_pedals(self):
+        res = self.client().delete(
+            '/pedals',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json=[706, 'x'])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['not_applied', 'invalid'])
+
+        res = self.client().delete(
+            '/pedals?atomic=false',
+            headers={
+                "Authorization": "Bearer {}".format(self.site_owner_token)
+            },
+            json=[706, 707, 5000, 706])
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['deleted', 'deleted', 'not_found', 'invalid'])
+        self.assertEqual(data['num_deleted'], 2)
+        self.assertEqual(self.client().get('/pedals/707').status_code, 404)
+
     # Test post manufacturer with RBAC success to /manufacturers
     # with Contributor credentials
 
@@ -343,5 +1613,314 @@ class TestPedalsAPI(unittest.TestCase):
         self.assertTrue(data, 'Permission not in permissions list')
 
 
+class TestPriceToCents(unittest.TestCase):
+    # Test price strings are parsed into integer cents
+
+    def test_price_to_cents(self):
+        self.assertEqual(price_to_cents('$90.00'), 9000)
+        self.assertEqual(price_to_cents('$2,221.00'), 222100)
+        self.assertEqual(price_to_cents(' $64.5 '), 6450)
+        self.assertEqual(price_to_cents('120'), 12000)
+
+    # Test empty and unparseable prices have no cents
+
+    def test_price_to_cents_invalid(self):
+        self.assertIsNone(price_to_cents(None))
+        self.assertIsNone(price_to_cents(''))
+        self.assertIsNone(price_to_cents('call for price'))
+
+
+class TestJWKSKeyStore(unittest.TestCase):
+    def setUp(self):
+        '''Run before tests'''
+        self.jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', delete=False)
+        self.write_jwks('kid-1')
+        self.store = JWKSKeyStore('file://' + self.jwks_file.name, ttl=600,
+                                  timeout=1, min_refresh_interval=0)
+
+    def tearDown(self):
+        '''Run after tests'''
+        if os.path.exists(self.jwks_file.name):
+            os.remove(self.jwks_file.name)
+
+    def write_jwks(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'AQAB'
+            } for kid in kids]}, f)
+
+    # Test keys are fetched once and then served from memory
+
+    def test_key_served_from_cache(self):
+        self.assertEqual(self.store.get_key('kid-1')['kid'], 'kid-1')
+        os.remove(self.jwks_file.name)
+
+        self.assertEqual(self.store.get_key('kid-1')['kid'], 'kid-1')
+
+    # Test unknown kid triggers a refresh that picks up rotated keys
+
+    def test_unknown_kid_refreshes(self):
+        self.store.get_key('kid-1')
+        self.write_jwks('kid-1', 'kid-2')
+
+        self.assertEqual(self.store.get_key('kid-2')['kid'], 'kid-2')
+
+    # Test unknown kid refreshes are rate limited
+
+    def test_unknown_kid_refresh_rate_limited(self):
+        self.store.min_refresh_interval = 600
+        self.store.get_key('kid-1')
+        self.write_jwks('kid-1', 'kid-2')
+
+        self.assertIsNone(self.store.get_key('kid-2'))
+
+    # Test stale keys keep being served when the fetch fails
+
+    def test_stale_keys_served_on_fetch_failure(self):
+        self.store.get_key('kid-1')
+        os.remove(self.jwks_file.name)
+        self.store.ttl = 0
+
+        self.store.refresh()
+        self.assertEqual(self.store.get_key('kid-1')['kid'], 'kid-1')
+
+    # Test fetch failure without any cached keys raises AuthError
+
+    def test_fetch_failure_without_keys(self):
+        os.remove(self.jwks_file.name)
+
+        with self.assertRaises(AuthError):
+            self.store.get_key('kid-1')
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        '''Run before tests'''
+        self.rsa_key = {'kty': 'RSA', 'kid': 'kid-1', 'use': 'sig',
+                        'n': 'n', 'e': 'AQAB'}
+        self.keys = {'kid-1': self.rsa_key}
+        self.key_store = type('KeyStore', (), {'peek': self.keys.get})()
+        self.cache = TokenCache(self.key_store, maxsize=2)
+
+    def payload(self, exp_in=3600):
+        return {'exp': int(time.time()) + exp_in, 'permissions': []}
+
+    # Test cached payload is returned and counted as a hit
+
+    def test_cache_hit(self):
+        payload = self.payload()
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.set('token', payload, self.rsa_key)
+
+        self.assertIs(self.cache.get('token'), payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    # Test expired entries are not served
+
+    def test_expired_entry_dropped(self):
+        self.cache.set('token', self.payload(-1), self.rsa_key)
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    # Test entries are dropped when their signing key rotates
+
+    def test_rotated_kid_dropped(self):
+        self.cache.set('token', self.payload(), self.rsa_key)
+        self.keys['kid-1'] = dict(self.rsa_key, n='rotated')
+
+        self.assertIsNone(self.cache.get('token'))
+
+    # Test least recently used entry is evicted when full
+
+    def test_lru_eviction(self):
+        for token in ('a', 'b'):
+            self.cache.set(token, self.payload(), self.rsa_key)
+        self.cache.get('a')
+        self.cache.set('c', self.payload(), self.rsa_key)
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        '''Run before tests'''
+        self.cache = ResponseCache(MemoryBackend(maxsize=2, ttl=60))
+
+    # Test hits and misses are counted
+
+    def test_hit_ratio(self):
+        self.assertIsNone(self.cache.get('/pedals'))
+        self.cache.set('/pedals', b'{}', ['pedals'])
+
+        self.assertEqual(self.cache.get('/pedals'), b'{}')
+        self.assertEqual(self.cache.stats()['hit_ratio'], 0.5)
+
+    # Test invalidation only drops entries tagged with the written keys
+
+    def test_invalidate_by_tag(self):
+        self.cache.set('/pedals', b'1', ['pedals'])
+        self.cache.set('/manufacturers', b'2', ['manufacturers'])
+        self.cache.invalidate(['pedals'])
+
+        self.assertIsNone(self.cache.get('/pedals'))
+        self.assertEqual(self.cache.get('/manufacturers'), b'2')
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    # Test least recently used entry is evicted and expired entries missed
+
+    def test_eviction_and_ttl(self):
+        self.cache.set('a', b'a', [])
+        self.cache.set('b', b'b', [])
+        self.cache.get('a')
+        self.cache.set('c', b'c', [])
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+        self.cache.backend.ttl = 0
+        self.cache.set('d', b'd', [])
+        self.assertIsNone(self.cache.get('d'))
+
+
+class TestConnectionPool(unittest.TestCase):
+    database_path = os.environ.get('DATABASE_URL_TESTING')
+
+    def engine(self, **options):
+        return create_engine(self.database_path, poolclass=TimedQueuePool,
+                             **options)
+
+    # Test the pool profiles
+
+    def test_engine_options(self):
+        options = engine_options('queue')
+        self.assertIs(options['poolclass'], TimedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+
+        self.assertEqual(engine_options('null'),
+                         {'poolclass': TimedNullPool})
+        with self.assertRaises(ValueError):
+            engine_options('pgbouncer')
+
+    # Test connections in use are tracked through checkout and checkin
+
+    def test_in_use_gauge(self):
+        engine = self.engine(pool_size=2, max_overflow=0)
+        in_use = pool_metrics.in_use
+        checkouts = pool_metrics.checkouts
+
+        with engine.connect() as connection:
+            connection.execute('SELECT 1')
+            self.assertEqual(pool_metrics.in_use, in_use + 1)
+            self.assertEqual(engine.pool.checkedout(), 1)
+
+        stats = pool_metrics.stats(engine.pool)
+        self.assertEqual(stats['in_use'], in_use)
+        self.assertEqual(stats['checkouts'], checkouts + 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['size'], 2)
+        engine.dispose()
+
+    # Test a checkout that times out waiting is counted
+
+    def test_checkout_timeout(self):
+        engine = self.engine(pool_size=1, max_overflow=0, pool_timeout=0.1)
+        timeouts = pool_metrics.timeouts
+
+        with engine.connect():
+            with self.assertRaises(exc.TimeoutError):
+                engine.connect()
+
+        self.assertEqual(pool_metrics.timeouts, timeouts + 1)
+        self.assertGreaterEqual(pool_metrics.wait_seconds_max, 0.1)
+        self.assertEqual(pool_metrics.waiting, 0)
+        engine.dispose()
+
+    # Test a dropped connection is replaced by the pre-ping
+
+    def test_pre_ping_replaces_dead_connection(self):
+        engine = self.engine(pool_size=1, pool_pre_ping=True)
+        invalidations = pool_metrics.invalidations
+
+        with engine.connect() as connection:
+            pid = connection.execute('SELECT pg_backend_pid()').scalar()
+        killer = self.engine()
+        with killer.connect() as connection:
+            connection.execute(
+                'SELECT pg_terminate_backend({})'.format(pid))
+        killer.dispose()
+
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute('SELECT 1').scalar(), 1)
+        self.assertEqual(pool_metrics.invalidations, invalidations + 1)
+        engine.dispose()
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry = Registry(self.directory.name, flush_interval=0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    # Test histograms are rendered with cumulative buckets
+
+    def test_histogram(self):
+        labels = (('route', '/pedals'),)
+        self.registry.observe('jwt_verify_duration_seconds', 0.002, labels)
+        self.registry.observe('jwt_verify_duration_seconds', 3, labels)
+        output = self.registry.render()
+
+        self.assertIn('jwt_verify_duration_seconds_bucket'
+                      '{route="/pedals",le="0.0025"} 1', output)
+        self.assertIn('jwt_verify_duration_seconds_bucket'
+                      '{route="/pedals",le="5"} 2', output)
+        self.assertIn('jwt_verify_duration_seconds_count'
+                      '{route="/pedals"} 2', output)
+
+    # Test workers' counters are summed, and exited workers' gauges dropped
+
+    def test_workers_aggregated(self):
+        self.registry.register('token_cache', lambda: [
+            ('token_cache_entries', (), 3),
+            ('token_cache_hits_total', (), 5)])
+        self.registry.inc('jwks_fetch_errors_total')
+
+        exited = 2 ** 22 + 1
+        with open(self.registry.path(exited), 'w') as f:
+            json.dump({'pid': exited, 'histograms': [],
+                       'counters': [['jwks_fetch_errors_total', [], 2]],
+                       'gauges': [['token_cache_entries', [], 7]]}, f)
+        output = self.registry.render()
+
+        self.assertIn('jwks_fetch_errors_total 3', output)
+        self.assertIn('token_cache_hits_total 5', output)
+        self.assertIn('token_cache_entries{{worker="{}"}} 3'.format(
+            os.getpid()), output)
+        self.assertNotIn('worker="{}"'.format(exited), output)
+
+    # Test the request hooks stay well under 50 microseconds
+
+    def test_request_overhead(self):
+        app = create_app()
+        response = app.response_class('')
+        with app.test_request_context('/pedals/1'):
+            app.preprocess_request()
+            runs = 2000
+            start = time.perf_counter()
+            for _ in range(runs):
+                start_request()
+                finish_request(response)
+            elapsed = (time.perf_counter() - start) / runs
+        registry.clear()
+
+        self.assertLess(elapsed, 50e-6)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# REQUEST_TRACING=on times the phases of sampled requests
+REQUEST_TRACING = os.environ.get('REQUEST_TRACING', 'off') == 'on'
+TRACE_SAMPLE = float(os.environ.get('TRACE_SAMPLE', 1))
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_LOG_EXPLAIN = os.environ.get('SLOW_LOG_EXPLAIN', 'off') == 'on'
+SLOW_LOG_MAX_STATEMENTS = int(os.environ.get('SLOW_LOG_MAX_STATEMENTS', 50))
+
+slow_log = logging.getLogger('pedalsdb.slow_requests')
+
+'''
+Request tracing
+
+An opt-in breakdown of where a request's time goes: token checks and
+JWKS fetches, SQL, formatting rows into pages, and serializing the
+JSON body. Each traced response carries the phases in a Server-Timing
+header, and traced requests slower than SLOW_REQUEST_MS are written to
+the pedalsdb.slow_requests logger as one JSON object with their SQL.
+TRACE_SAMPLE is the fraction of requests traced, so tracing can stay on
+in production at a small cost.
+'''
+
+
+class Trace:
+    '''Phase timings and SQL statements of one request.'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.statements = []
+        self.dropped = 0
+
+    def add(self, name, seconds):
+        total, count = self.phases.get(name, (0.0, 0))
+        self.phases[name] = (total + seconds, count + 1)
+
+    def add_statement(self, engine, statement, parameters, seconds):
+        self.add('db', seconds)
+        if len(self.statements) < SLOW_LOG_MAX_STATEMENTS:
+            self.statements.append((engine, statement, parameters, seconds))
+        else:
+            self.dropped += 1
+
+    def server_timing(self, total):
+        entries = []
+        for name, (seconds, count) in sorted(self.phases.items()):
+            entries.append('{};dur={:.2f};desc="{} {}"'.format(
+                name, seconds * 1000, count,
+                'queries' if name == 'db' else 'calls'))
+        entries.append('total;dur={:.2f}'.format(total * 1000))
+        return ', '.join(entries)
+
+
+_current = threading.local()
+
+
+def current_trace():
+    return getattr(_current, 'trace', None)
+
+
+@contextmanager
+def phase(name):
+    '''Times the block as part of phase name of the current trace.'''
+    trace = current_trace()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - start)
+
+
+def traced(name):
+    '''Decorates a function to time its calls as phase name.'''
+    def traced_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            trace = current_trace()
+            if trace is None:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                trace.add(name, time.perf_counter() - start)
+        return wrapper
+    return traced_decorator
+
+# Capture SQL with engine events
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    if current_trace() is not None and context is not None:
+        context.trace_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    trace = current_trace()
+    if trace is None or getattr(context, 'trace_start', None) is None:
+        return
+    trace.add_statement(conn.engine, statement,
+                        None if executemany else parameters,
+                        time.perf_counter() - context.trace_start)
+
+# Slow request log
+
+
+def loggable(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, dict):
+        return {str(key): loggable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [loggable(item) for item in value]
+    return repr(value)
+
+
+def explain(engine, statement, parameters):
+    '''
+    Runs EXPLAIN (ANALYZE, BUFFERS) for a SELECT on the database it ran
+    on. ANALYZE runs the query again, so writes and locking reads are
+    not explained.
+    '''
+    sql = statement.lstrip().upper()
+    if (parameters is None or not sql.startswith('SELECT') or
+            'FOR UPDATE' in sql):
+        return None
+    try:
+        with engine.connect() as connection:
+            rows = connection.execution_options(budgeted=False).execute(
+                'EXPLAIN (ANALYZE, BUFFERS) ' + statement, parameters)
+            return [row[0] for row in rows]
+    except Exception as error:
+        return 'EXPLAIN failed: {}'.format(error)
+
+
+def log_slow_request(trace, response, total, run_explain=False):
+    statements = []
+    for engine, statement, parameters, seconds in trace.statements:
+        entry = {
+            'sql': statement,
+            'parameters': loggable(parameters),
+            'ms': round(seconds * 1000, 2)
+        }
+        if run_explain:
+            entry['explain'] = explain(engine, statement, parameters)
+        statements.append(entry)
+
+    slow_log.warning(json.dumps({
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'status': response.status_code,
+        'ms': round(total * 1000, 2),
+        'phases': {name: round(seconds * 1000, 2)
+                   for name, (seconds, _) in trace.phases.items()},
+        'statements': statements,
+        'statements_dropped': trace.dropped
+    }, sort_keys=True))
+
+# Trace requests from Flask hooks
+
+
+class Tracer:
+    '''Starts a trace for a sample of requests and reports it.'''
+
+    def __init__(self, enabled=REQUEST_TRACING, sample=TRACE_SAMPLE,
+                 slow_ms=SLOW_REQUEST_MS, explain=SLOW_LOG_EXPLAIN):
+        self.enabled = enabled
+        self.sample = sample
+        self.slow_ms = slow_ms
+        self.explain = explain
+
+    def start(self):
+        _current.trace = None
+        if self.enabled and random.random() < self.sample:
+            _current.trace = Trace()
+
+    def finish(self, response):
+        trace = current_trace()
+        if trace is None:
+            return response
+        _current.trace = None
+        total = time.perf_counter() - trace.start
+
+        response.headers['Server-Timing'] = trace.server_timing(total)
+        if total * 1000 >= self.slow_ms:
+            log_slow_request(trace, response, total, self.explain)
+        return response
+
+
+tracer = Tracer()
+
+
+def trace_requests(app):
+    app.before_request(tracer.start)
+    app.after_request(tracer.finish)
@@ -0,0 +1,130 @@
+import calendar
+import hashlib
+import itertools
+import threading
+import time
+import uuid
+from functools import wraps
+from flask import make_response, request
+
+# Shared stamps are stored under their keys, and the default one here
+DEFAULT_STAMP_KEY = '*'
+
+'''
+Version stamps
+
+Each cacheable resource (a table, or one manufacturer's pedals) has a
+stamp that changes whenever a write to it commits. Read endpoints turn
+the stamps they depend on into an ETag and Last-Modified before running
+any query, so a client that already has the current representation gets
+a 304 without the rows being loaded or serialized.
+'''
+
+
+def manufacturer_pedals_key(manufacturer_id):
+    return 'manufacturers/{}/pedals'.format(manufacturer_id)
+
+
+class VersionStamps:
+    '''
+    Stamps are a per-boot token plus a counter, so no two writes share
+    one. A bump may carry a stamp made by another worker so that every
+    worker agrees on the keys written while they run, and load() takes
+    the stamps stored by every write so far, so that workers started at
+    different times agree too. Keys that have never been written share
+    a default stamp, stored by the first worker to start; until the
+    stored stamps are loaded it is this worker's boot stamp and time.
+    Listeners are called with the keys after every bump.
+    '''
+
+    def __init__(self):
+        self.boot = uuid.uuid4().hex[:8]
+        self.boot_time = int(time.time())
+        self.default = (self.boot, self.boot_time)
+        self._counter = itertools.count(1)
+        self._stamps = {}
+        self._lock = threading.Lock()
+        self.listeners = []
+
+    def get(self, key):
+        return self._stamps.get(key, self.default)
+
+    def new_stamp(self):
+        return '{}.{}'.format(self.boot, next(self._counter)), int(time.time())
+
+    def bump(self, keys, stamp=None, modified=None):
+        if stamp is None:
+            stamp, modified = self.new_stamp()
+        with self._lock:
+            for key in keys:
+                self._stamps[key] = (stamp, modified)
+        for listener in self.listeners:
+            listener(keys)
+
+    def load(self, rows):
+        '''
+        Takes the stored stamps, (key, stamp, modified) rows, and bumps
+        the keys whose stamp isn't the one this worker has.
+        '''
+        rows = {key: (stamp, modified) for key, stamp, modified in rows}
+        self.default = rows.pop(DEFAULT_STAMP_KEY, self.default)
+        changed = {}
+        for key, stamp in rows.items():
+            if self.get(key) != stamp:
+                changed.setdefault(stamp, []).append(key)
+        for (stamp, modified), keys in changed.items():
+            self.bump(keys, stamp, modified)
+
+    def validators(self, keys):
+        '''Returns the ETag value and Last-Modified time for keys.'''
+        stamps = [self.get(key) for key in keys]
+        digest = hashlib.sha1('|'.join(
+            '{}={}'.format(key, stamp)
+            for key, (stamp, _) in zip(keys, stamps)).encode('utf-8'))
+        return digest.hexdigest()[:20], max(t for _, t in stamps)
+
+    def clear(self):
+        with self._lock:
+            self._stamps.clear()
+
+
+stamps = VersionStamps()
+
+
+def resolve_keys(keys, view_args):
+    '''Keys may be callables taking the view's keyword arguments.'''
+    return [key(**view_args) if callable(key) else key for key in keys]
+
+# Answer conditional GETs from the version stamps
+
+
+def conditional(*keys):
+    '''
+    Decorates a GET view with strong ETag and Last-Modified validators
+    built from keys. If-None-Match takes precedence over
+    If-Modified-Since.
+    '''
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag, modified = stamps.validators(resolve_keys(keys, kwargs))
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = (
+                    since is not None and
+                    modified <= calendar.timegm(since.utctimetuple()))
+
+            if not_modified:
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.last_modified = modified
+            return response
+        return wrapper
+    return decorator